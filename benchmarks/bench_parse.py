@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Compare the throughput (rows/second) of the csv.DictReader based parsing
+path (parse_clark_abundance_tbl) with the columnar reader
+(read_clark_columns) on a synthetic CLARK abundance table.
+
+Usage::
+
+    $ python benchmarks/bench_parse.py --rows 200000 --repeat 3
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import csv
+import io
+import os.path as osp
+import sys
+import timeit
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+import clark_biom as cb
+from benchmarks.synth import synth_clark_tbl
+
+
+def dictreader_path(text):
+    cdr = csv.DictReader(io.StringIO(text), fieldnames=cb.field_names)
+    data = [entry for entry in cdr][1:]
+    return cb.parse_clark_abundance_tbl(data)
+
+
+def columnar_path(text):
+    cols = cb.read_clark_columns(io.StringIO(text), columns=("Count",))
+    taxa = [cb.tax_fmt(lineage, name)
+            for lineage, name in zip(cols.lineages, cols.names)]
+    return cols, taxa
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    text = synth_clark_tbl(args.rows)
+    for label, func in [("DictReader", dictreader_path),
+                        ("columnar", columnar_path)]:
+        best = min(timeit.repeat(lambda: func(text), number=1,
+                                 repeat=args.repeat))
+        print("{:<12} {:>12,.0f} rows/s  ({:.3f}s)".format(
+              label, args.rows / best, best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Time each stage of the clark-biom pipeline on a synthetic cohort (see
+benchmarks/synth.py) and record the peak memory (resident set size) reached
+during it. The peak is reset between stages through /proc/self/clear_refs,
+so per-stage figures require Linux; elsewhere the process-wide peak is
+reported.
+
+Stages: process_samples, create_biom_table (dense and sparse),
+stream + build_sparse_table, and write_biom for each output format.
+
+Usage::
+
+    $ python benchmarks/bench_pipeline.py --samples 200 --taxa-per-sample 2000
+    $ python benchmarks/bench_pipeline.py --cohort-dir cohort/ --json out.json
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+from collections import OrderedDict
+import glob
+import json
+import os
+import os.path as osp
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+import clark_biom as cb
+from benchmarks.synth import write_cohort
+
+
+def run_stage(results, name, func, *args, **kwargs):
+    """
+    Run func, recording its wall time and peak RSS in results.
+    """
+    cb.reset_peak_rss()
+    start = time.time()
+    out = func(*args, **kwargs)
+    elapsed = time.time() - start
+    peak = cb.peak_rss_mb()
+
+    results[name] = {"seconds": round(elapsed, 4), "peak_rss_mb": round(peak, 1)}
+    print("{:<28} {:>9.3f}s {:>10.1f} MB".format(name, elapsed, peak))
+
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cohort-dir', 
+                        help="Use (or create) the synthetic cohort in this "
+                             "directory instead of a temporary one.")
+    parser.add_argument('--samples', type=int, default=100)
+    parser.add_argument('--taxa-per-sample', type=int, default=1000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--overlap', type=float, default=0.5)
+    parser.add_argument('--skip-dense', action='store_true',
+                        help="Skip the dense create_biom_table stage, which "
+                             "can need a lot of memory for large cohorts.")
+    parser.add_argument('--json', metavar="PATH",
+                        help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    cohort_dir = args.cohort_dir or osp.join(work_dir, "cohort")
+    fps = sorted(glob.glob(osp.join(cohort_dir, "*.csv")))
+    if not fps:
+        fps = write_cohort(cohort_dir, args.samples, args.taxa_per_sample,
+                           args.density, args.overlap)
+
+    results = OrderedDict()
+    try:
+        sample_counts, taxa = run_stage(results, "process_samples",
+                                        cb.process_samples, fps)
+        if not args.skip_dense:
+            run_stage(results, "create_biom_table[dense]", 
+                      cb.create_biom_table, sample_counts, taxa)
+        biomT = run_stage(results, "create_biom_table[sparse]",
+                          cb.create_biom_table, sample_counts, taxa, 
+                          sparse=True)
+        del sample_counts
+
+        builder = run_stage(results, "stream+build_sparse_table",
+                            cb.build_sparse_table, cb.stream_samples(fps))
+
+        for fmt, gzip in [("hdf5", False), ("json", False), ("json", True),
+                          ("tsv", False), ("tsv", True)]:
+            if fmt == "hdf5" and not cb.HAVE_H5PY:
+                continue
+            name = "write_biom[{}{}]".format(fmt, "+gzip" if gzip else "")
+            out_fp = run_stage(results, name, cb.write_biom, biomT, 
+                               osp.join(work_dir, "table." + fmt), fmt, gzip)
+            results[name]["bytes"] = os.path.getsize(out_fp)
+        if cb.HAVE_H5PY:
+            out_fp = run_stage(results, "write_hdf5_direct", 
+                               cb.write_hdf5_direct, builder, 
+                               osp.join(work_dir, "direct.biom"))
+            results["write_hdf5_direct"]["bytes"] = os.path.getsize(out_fp)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.json:
+        with open(args.json, "w") as out_f:
+            json.dump({"files": len(fps), "stages": results}, out_f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
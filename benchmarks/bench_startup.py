@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Measure the start-up cost of clark-biom: the time taken to import the
+clark_biom module and to run 'clark-biom --help' in a fresh interpreter,
+along with the import time of each of the heavy dependencies (which should
+only be paid once they are actually used).
+
+Every measurement runs in a new Python process, so nothing is served from
+modules that are already imported.
+
+Usage::
+
+    $ python benchmarks/bench_startup.py --repeat 10 --json startup.json
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+from collections import OrderedDict
+import json
+import os.path as osp
+import subprocess
+import sys
+
+repo_dir = osp.dirname(osp.dirname(osp.abspath(__file__)))
+heavy_modules = ["numpy", "scipy.sparse", "biom", "h5py"]
+
+import_snippet = """\
+import sys, time
+sys.path.insert(0, {repo_dir!r})
+start = time.time()
+import {module}
+elapsed = time.time() - start
+loaded = [m for m in {heavy!r} if m in sys.modules]
+print(repr((elapsed, loaded)))
+"""
+
+help_snippet = """\
+import runpy, sys, time
+sys.argv = [{script!r}, "--help"]
+start = time.time()
+try:
+    runpy.run_path({script!r}, run_name="__main__")
+except SystemExit:
+    pass
+sys.stderr.write(repr(time.time() - start))
+"""
+
+
+def run_python(code):
+    proc = subprocess.Popen([sys.executable, "-c", code],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError(err.decode("utf-8", "replace"))
+
+    return out.decode("utf-8"), err.decode("utf-8")
+
+
+def time_import(module, repeat):
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        out, _ = run_python(import_snippet.format(repo_dir=repo_dir,
+                                                  module=module,
+                                                  heavy=heavy_modules))
+        elapsed, loaded = eval(out.strip().splitlines()[-1])
+        times.append(elapsed)
+
+    return times, loaded
+
+
+def time_help(repeat):
+    script = osp.join(repo_dir, "clark_biom.py")
+    times = []
+    for _ in range(repeat):
+        _, err = run_python(help_snippet.format(script=script))
+        times.append(float(err.strip().splitlines()[-1]))
+
+    return times
+
+
+def summarize(times):
+    times = sorted(times)
+    return OrderedDict([("min_ms", 1000 * times[0]),
+                        ("median_ms", 1000 * times[len(times) // 2])])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', metavar="PATH",
+                        help="Also write the results to this file as JSON.")
+    args = parser.parse_args()
+
+    results = OrderedDict()
+    times, loaded = time_import("clark_biom", args.repeat)
+    results["import clark_biom"] = summarize(times)
+    results["import clark_biom"]["heavy_modules_loaded"] = loaded
+    results["clark-biom --help"] = summarize(time_help(args.repeat))
+    for module in heavy_modules:
+        try:
+            times, _ = time_import(module, args.repeat)
+        except RuntimeError:
+            continue
+        results["import " + module] = summarize(times)
+
+    print("{:<24} {:>10} {:>12}".format("", "Min (ms)", "Median (ms)"))
+    for name, rec in results.items():
+        print("{:<24} {:>10.1f} {:>12.1f}".format(name, rec["min_ms"],
+                                                  rec["median_ms"]))
+    print("Heavy modules loaded by 'import clark_biom': {}".format(
+          ", ".join(results["import clark_biom"]["heavy_modules_loaded"])
+          or "none"))
+
+    if args.json:
+        with open(args.json, "w") as out_f:
+            json.dump(results, out_f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Generate synthetic cohorts of CLARK abundance tables (the output of
+estimate_abundance.sh) for benchmarking clark-biom.
+
+The cohort is described by the number of samples, the number of taxa
+reported per sample, the density of the final table (taxa per sample / total
+number of distinct taxa), and the overlap between samples: the fraction of
+each sample's taxa drawn from a "core" set shared by every sample.
+
+Usage::
+
+    $ python benchmarks/synth.py cohort/ --samples 500 --taxa-per-sample 2000
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import io
+import os
+import os.path as osp
+import random
+
+header = (u"Name,TaxID,Lineage,Count,Proportion_All(%),"
+          u"Proportion_Classified(%)\n")
+
+
+def synth_taxon(i):
+    """Return the (name, taxid, lineage) for the i-th synthetic taxon."""
+    genus = u"Genus{}".format(i // 10)
+    lineage = u";".join([u"Bacteria", u"Phylum{}".format(i % 40),
+                         u"Class{}".format(i % 90), u"Order{}".format(i % 200),
+                         u"Family{}".format(i % 500), genus])
+
+    return u"{} species{}".format(genus, i), 1000 + i, lineage
+
+
+def synth_clark_rows(taxa, rng):
+    """Yield the CLARK table rows (including the header) for the taxa."""
+    counts = [rng.randint(1, 5000) for _ in taxa]
+    classified = sum(counts)
+    unknown = rng.randint(0, classified)
+    total = classified + unknown
+
+    yield header
+    for i, count in zip(taxa, counts):
+        name, taxid, lineage = synth_taxon(i)
+        yield u"{},{},{},{},{:.6g},{:.6g}\n".format(name, taxid, lineage, count,
+                                                    100 * count / total,
+                                                    100 * count / classified)
+    yield u"UNKNOWN,UNKNOWN,UNKNOWN,{},{:.6g},-\n".format(unknown, 
+                                                         100 * unknown / total)
+
+
+def synth_clark_tbl(ntaxa, seed=0):
+    """Return the text of a single synthetic CLARK abundance table."""
+    rng = random.Random(seed)
+
+    return u"".join(synth_clark_rows(range(ntaxa), rng))
+
+
+def write_cohort(out_dir, samples=100, taxa_per_sample=1000, density=0.05,
+                 overlap=0.5, seed=0):
+    """
+    Write a synthetic cohort of CLARK abundance tables to out_dir.
+
+    :rtype: list of str
+    :return: The paths of the files written, one per sample.
+    """
+    rng = random.Random(seed)
+    ntaxa = max(taxa_per_sample, int(round(taxa_per_sample / density)))
+    ncore = int(round(taxa_per_sample * overlap))
+    core = rng.sample(range(ntaxa), ncore)
+    rest = sorted(set(range(ntaxa)).difference(core))
+
+    if not osp.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    fps = []
+    for s in range(samples):
+        taxa = sorted(core + rng.sample(rest, taxa_per_sample - ncore))
+        fp = osp.join(out_dir, "S{:06d}.csv".format(s))
+        with io.open(fp, "wt") as out_f:
+            out_f.writelines(synth_clark_rows(taxa, rng))
+        fps.append(fp)
+
+    return fps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out_dir')
+    parser.add_argument('--samples', type=int, default=100)
+    parser.add_argument('--taxa-per-sample', type=int, default=1000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--overlap', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fps = write_cohort(args.out_dir, args.samples, args.taxa_per_sample,
+                       args.density, args.overlap, args.seed)
+    print("Wrote {} files to {}".format(len(fps), args.out_dir))
+
+
+if __name__ == '__main__':
+    main()
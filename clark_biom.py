@@ -9,22 +9,99 @@ CLARK output (http://clark.cs.ucr.edu/).
 from __future__ import absolute_import, division, print_function
 
 import argparse
-from collections import OrderedDict
+import bz2
+from collections import deque, OrderedDict, namedtuple
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from contextlib import contextmanager
+from itertools import chain
 import csv
 from datetime import datetime as dt
+from fnmatch import fnmatchcase
 from gzip import open as gzip_open
+import hashlib
+import importlib
+import io
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
 import os.path as osp
+import signal
 import sys
+import tempfile
+import threading
 from textwrap import dedent as twdd
+import time
+import zipfile
+import zlib
+
+
+
+class _LazyModule(object):
+    """
+    Stand-in for a module that is only imported when one of its attributes
+    is first used. The heavy dependencies (NumPy, SciPy, biom and h5py) are
+    loaded this way so that argument parsing, and --help, run before any
+    of them are imported.
+    """
+    def __init__(self, name):
+        self.__dict__["_LazyModule__name"] = name
 
-from biom.table import Table
-import numpy as np
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name)
+        # later lookups are served directly from the instance dict
+        self.__dict__.update(module.__dict__)
+
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazy module '{}'>".format(self.__name)
+
+
+def _module_available(name):
+    """
+    Check whether a module can be imported, without importing it.
+    """
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        from pkgutil import find_loader as find_spec
+    try:
+        return find_spec(name) is not None
+    except ImportError:
+        return False
+
+
+biom = _LazyModule("biom")
+np = _LazyModule("numpy")
+sp = _LazyModule("scipy.sparse")
+h5py = _LazyModule("h5py")
+HAVE_H5PY = _module_available("h5py")
 
 try:
-    import h5py
-    HAVE_H5PY = True
+    import lzma
+    HAVE_LZMA = True
 except ImportError:
-    HAVE_H5PY = False
+    HAVE_LZMA = False
+
+# errors raised when reading a missing, unreadable or corrupt input file
+read_errors = (OSError, IOError, EOFError, zlib.error)
+if HAVE_LZMA:
+    read_errors += (lzma.LZMAError,)
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import resource
+    HAVE_RESOURCE = True
+except ImportError:
+    HAVE_RESOURCE = False
 
 __author__ = "Shareef M. Dabdoub"
 __copyright__ = "Copyright 2018, Shareef M. Dabdoub"
@@ -38,7 +115,12 @@ __version__ = '1.0.0'
 
 field_names = ["Name", "TaxID", "Lineage", "Count",
                 "Proportion_All(%)", "Proportion_Classified(%)"]
+value_fields = ["Count", "Proportion_All(%)", "Proportion_Classified(%)"]
 ranks = ["k", "p", "c", "o", "f", "g", "s"]
+# names of the value columns that can be written to tables (see --values)
+value_kinds = OrderedDict([("count", "Count"), 
+                           ("pct", "Proportion_Classified(%)"),
+                           ("pct_all", "Proportion_All(%)")])
 
 
 
@@ -66,6 +148,212 @@ def tax_fmt(lineage, name):
     return tax
 
 
+class TaxonomyCache(object):
+    """
+    A bounded cache of formatted taxonomies shared across samples.
+
+    Taxonomies are interned on (lineage, name), so every occurrence of the
+    same lineage refers to a single list object, and once a taxon ID has
+    been seen its taxonomy is returned without reformatting. Both maps are
+    bounded to `maxsize` entries with least-recently-used eviction.
+
+    The taxonomy of a known taxon ID is only reused while its lineage is
+    unchanged, so a taxon ID given a different lineage by another sample
+    gets the taxonomy of that lineage (see LineageChecker).
+    """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._by_taxid = OrderedDict()
+        self._by_lineage = OrderedDict()
+
+    def __len__(self):
+        return len(self._by_lineage)
+
+    def _store(self, cache, key, tax):
+        cache[key] = tax
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+
+    def get(self, taxid, lineage, name):
+        """
+        Return the formatted taxonomy (see tax_fmt) for a taxon.
+        """
+        key = (lineage, name)
+        entry = self._by_taxid.pop(taxid, None)
+        if entry is None or entry[0] != key:
+            tax = self._by_lineage.pop(key, None)
+            if tax is None:
+                self.misses += 1
+                tax = tax_fmt(lineage, name)
+            else:
+                self.hits += 1
+            self._store(self._by_lineage, key, tax)
+            entry = (key, tax)
+        else:
+            self.hits += 1
+        self._store(self._by_taxid, taxid, entry)
+
+        return entry[1]
+
+    def stats(self):
+        """
+        Return a summary of the cache usage suitable for status messages.
+        """
+        lookups = self.hits + self.misses
+        return ("Taxonomy cache: {} hits, {} misses "
+                "({:.1%} hit rate)").format(self.hits, self.misses,
+                                            self.hits / lookups if lookups else 0)
+
+
+BatchTaxonomy = namedtuple("BatchTaxonomy", ["taxonomies", "inverse", 
+                                             "rank_names", "codes"])
+
+
+def rank_codes(taxonomies):
+    """
+    Encode formatted taxonomies (see tax_fmt) as integer codes per rank.
+
+    :type taxonomies: list
+    :param taxonomies: The formatted taxonomies (lists of rank-prefixed
+                       names).
+    :return: A list with the sorted, unique names at each of the 'ranks',
+             and an int32 array (taxonomies x ranks) of the position of each
+             taxonomy's name in those lists, or -1 where a taxonomy does
+             not reach the rank.
+    """
+    codes = np.empty((len(taxonomies), len(ranks)), dtype=np.int32)
+    rank_names = []
+    for level in range(len(ranks)):
+        column = np.array([tax[level] if len(tax) > level else ""
+                           for tax in taxonomies], dtype=np.str_)
+        names, inverse = np.unique(column, return_inverse=True)
+        if names.size and names[0] == "":
+            # the empty string sorts first: it marks taxonomies that end
+            # above this rank
+            names = names[1:]
+            inverse = inverse - 1
+        rank_names.append(names)
+        codes[:, level] = inverse.reshape(-1)
+
+    return rank_names, codes
+
+
+def batch_taxonomy(lineages, names):
+    """
+    Format the lineage and name columns of a whole cohort at once.
+
+    This is a library entry point for callers that already hold the raw
+    columns; the command-line pipeline formats each file through a
+    TaxonomyCache instead. The (lineage, name) pairs are deduplicated with
+    NumPy and each distinct pair is then formatted by tax_fmt (in Python),
+    so the cost depends on the number of distinct lineages rather than the
+    number of rows.
+
+    :type lineages: list or numpy.ndarray
+    :param lineages: Semi-colon separated taxonomic levels of each row.
+    :type names: list or numpy.ndarray
+    :param names: The scientific name of each row.
+    :return: A BatchTaxonomy of the formatted taxonomy of each distinct
+             (lineage, name) pair, the position of each row's pair in it
+             (inverse), and the per-rank names and integer codes of the
+             taxonomies (see rank_codes). The codes of the rows are 
+             codes[inverse].
+    """
+    lineages = np.asarray(lineages, dtype=np.str_)
+    names = np.asarray(names, dtype=np.str_)
+    if len(lineages) != len(names):
+        raise RuntimeError("ERROR: {} lineages given for {} names.".format(
+                           len(lineages), len(names)))
+
+    keys = np.empty(len(lineages), dtype=[("lineage", lineages.dtype),
+                                          ("name", names.dtype)])
+    keys["lineage"] = lineages
+    keys["name"] = names
+    unique, inverse = np.unique(keys, return_inverse=True)
+    taxonomies = [tax_fmt(lineage, name) 
+                  for lineage, name in unique.tolist()]
+    rank_names, codes = rank_codes(taxonomies)
+
+    return BatchTaxonomy(taxonomies, inverse.reshape(-1), rank_names, codes)
+
+
+class LineageChecker(object):
+    """
+    Find the taxon IDs given different lineages by different samples, while
+    the samples are streamed (see record_lineages).
+
+    One taxonomy is kept per taxon ID (shared with the TaxonomyCache, so
+    this costs little memory), and sample IDs are only recorded for the 
+    taxon IDs whose taxonomy differs between samples. For the taxonomy
+    seen before the first difference, only the first sample that gave it
+    is recorded; every later sample is recorded under its taxonomy.
+    """
+    def __init__(self):
+        # taxon ID -> (taxonomy, first sample ID), or (None, None) once the
+        # taxon ID is in conflicts
+        self._seen = {}
+        # taxon ID -> OrderedDict of taxonomy (joined with ';') -> sample IDs
+        self.conflicts = OrderedDict()
+
+    def __len__(self):
+        return len(self.conflicts)
+
+    def add_sample(self, sample_id, taxids, taxonomies):
+        """
+        Check the taxonomies of a sample's taxon IDs against those of the
+        earlier samples.
+        """
+        seen = self._seen
+        for taxid, tax in zip(taxids.tolist(), taxonomies):
+            entry = seen.get(taxid)
+            if entry is None:
+                seen[taxid] = (tax, sample_id)
+            elif entry[0] is not tax:
+                self._check(taxid, entry, tax, sample_id)
+
+    def _check(self, taxid, entry, tax, sample_id):
+        by_lineage = self.conflicts.get(taxid)
+        if by_lineage is None:
+            if entry[0] == tax:
+                return
+            by_lineage = OrderedDict([(";".join(entry[0]), [entry[1]])])
+            self.conflicts[taxid] = by_lineage
+            self._seen[taxid] = (None, None)
+        samples = by_lineage.setdefault(";".join(tax), [])
+        if not samples or samples[-1] != sample_id:
+            samples.append(sample_id)
+
+
+def record_lineages(samples, checker):
+    """
+    Pass through a stream of parsed samples (see stream_samples), checking
+    the taxonomies of each with the LineageChecker.
+    """
+    for sample in samples:
+        checker.add_sample(sample[0], sample[1], sample[3])
+        yield sample
+
+
+def write_lineage_report(checker, fp):
+    """
+    Write the taxon IDs a LineageChecker found to have inconsistent
+    lineages to a tab-separated file with the columns TaxID, Taxonomy and
+    Samples, one line per taxon ID and lineage.
+
+    :return: The number of taxon IDs with inconsistent lineages.
+    """
+    with open(fp, "w") as out_f:
+        out_f.write("TaxID\tTaxonomy\tSamples\n")
+        for taxid, by_lineage in checker.conflicts.items():
+            for lineage, samples in by_lineage.items():
+                out_f.write("{}\t{}\t{}\n".format(taxid, lineage, 
+                                                  ",".join(samples)))
+
+    return len(checker)
+
+
 def parse_clark_abundance_tbl(data, store_pct=False):
     """
     Parse a single output file from estimate_abundance.sh. Return a list
@@ -95,37 +383,1106 @@ def parse_clark_abundance_tbl(data, store_pct=False):
     return counts, taxa
 
 
-def process_samples(clark_abd_fps, store_pct=False):
+class _PrefetchReader(io.RawIOBase):
     """
-    Parse all clark abundance tables into sample counts dict
-    and store global taxon id -> taxonomy data
+    A raw binary stream that reads (and so, for compressed files,
+    decompresses) the wrapped file object in a background thread, handing
+    blocks to the consumer through a bounded queue. This overlaps the
+    decompression with the parsing of the data.
     """
-    taxa = OrderedDict()
-    sample_counts = OrderedDict()
-    for clark_fp in clark_abd_fps:
-        if not osp.isfile(clark_fp):
-            raise RuntimeError("ERROR: File '{}' not found.".format(clark_fp))
+    def __init__(self, fileobj, block_size=2**18, depth=4):
+        super(_PrefetchReader, self).__init__()
+        self._fileobj = fileobj
+        self._block_size = block_size
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._block = b""
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fill(self):
+        try:
+            while True:
+                block = self._fileobj.read(self._block_size)
+                if not self._put(block) or not block:
+                    break
+        except Exception as err:
+            self._put(err)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while self._pos >= len(self._block):
+            if self._eof:
+                return 0
+            block = self._queue.get()
+            if isinstance(block, Exception):
+                self._eof = True
+                raise block
+            if not block:
+                self._eof = True
+                return 0
+            self._block, self._pos = block, 0
+        n = min(len(buf), len(self._block) - self._pos)
+        buf[:n] = self._block[self._pos:self._pos+n]
+        self._pos += n
+
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._fileobj.close()
+        super(_PrefetchReader, self).close()
+
+
+# magic bytes at the start of compressed files -> compression format
+_compression_magic = [(b"\x1f\x8b", "gz"), (b"BZh", "bz2"), 
+                       (b"\xfd7zXZ\x00", "xz")]
+compressed_exts = [".gz", ".bz2", ".xz"]
+
+
+def open_clark_file(clark_fp, data=None):
+    """
+    Open a CLARK abundance table for reading in text mode. Files compressed
+    with gzip, bzip2 or xz are detected from their first bytes and
+    decompressed on the fly in a background thread.
+
+    :type clark_fp: str
+    :param clark_fp: Path to a (possibly compressed) result file from 
+                     estimate_abundance.sh.
+    :type data: bytes
+    :param data: The contents of the file, if they have already been read
+                 (see prefetch_files). The file is then not opened again.
+    """
+    if data is None:
+        with open(clark_fp, "rb") as cf:
+            magic = cf.read(6)
+    else:
+        magic = data[:6]
+
+    fmt = None
+    for prefix, name in _compression_magic:
+        if magic.startswith(prefix):
+            fmt = name
+            break
+    if fmt is None:
+        if data is None:
+            return open(clark_fp, "rt")
+        return io.TextIOWrapper(io.BytesIO(data), encoding="utf-8", 
+                                newline="")
+
+    src = clark_fp if data is None else io.BytesIO(data)
+    if fmt == "gz":
+        fileobj = gzip_open(src, "rb")
+    elif fmt == "bz2":
+        fileobj = bz2.BZ2File(src, "rb")
+    elif HAVE_LZMA:
+        fileobj = lzma.open(src, "rb")
+    else:
+        raise RuntimeError("ERROR: Reading xz-compressed files requires the "
+                           "'lzma' module: {}".format(clark_fp))
+
+    return io.TextIOWrapper(io.BufferedReader(_PrefetchReader(fileobj)), 
+                            encoding="utf-8", newline="")
+
+
+def _read_file(clark_fp):
+    """
+    Read the contents of a file, or return None if it can't be read (the
+    error is then raised when the file is parsed).
+    """
+    try:
+        with open(clark_fp, "rb") as cf:
+            return cf.read()
+    except (IOError, OSError):
+        return None
+
+
+def prefetch_files(clark_abd_fps, depth=4, skip=None):
+    """
+    Read the contents of upcoming input files in a pool of threads while the
+    current ones are being parsed, overlapping the (network) file system 
+    latency with the parsing.
+
+    :type clark_abd_fps: iterable
+    :param clark_abd_fps: Paths to the abundance tables, or SampleEntry-like
+                          items (see sample_entry).
+    :type depth: int
+    :param depth: Number of files read ahead (and reading threads), which
+                  bounds the number of files held in memory.
+    :type skip: function
+    :param skip: If given, files for which skip(path) is true are not read
+                 (e.g. those served from a ParseCache, see 
+                 ParseCache.contains).
+    :return: Yields a (SampleEntry, contents) tuple for each file, in input
+             order. The contents are None if the file was skipped or could
+             not be read.
+    """
+    pool = ThreadPool(depth)
+    pending = deque()
+    try:
+        for item in clark_abd_fps:
+            entry = sample_entry(item)
+            result = None
+            if skip is None or not skip(entry.path):
+                result = pool.apply_async(_read_file, (entry.path,))
+            pending.append((entry, result))
+            if len(pending) > depth:
+                entry, result = pending.popleft()
+                yield entry, result.get() if result is not None else None
+        while pending:
+            entry, result = pending.popleft()
+            yield entry, result.get() if result is not None else None
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def sample_id_from_fp(clark_fp):
+    """
+    Derive a sample ID from an abundance table path: the filename up to the
+    extension, ignoring any compression extension (e.g. S1.csv.gz -> S1).
+    """
+    fname = osp.split(clark_fp)[1]
+    root, ext = osp.splitext(fname)
+    if ext.lower() in compressed_exts:
+        fname = root
+
+    return osp.splitext(fname)[0]
+
+
+SampleEntry = namedtuple("SampleEntry", ["path", "sample_id", "group"])
+
+
+def sample_entry(item):
+    """
+    Normalize an input sample to a SampleEntry. The item can be the path to
+    an abundance table (the sample ID is then derived from the filename), or
+    a (path, sample ID[, group]) sequence.
+    """
+    if isinstance(item, str):
+        item = (item,)
+    path = item[0]
+    sample_id = item[1] if len(item) > 1 and item[1] else sample_id_from_fp(path)
+    group = item[2] if len(item) > 2 else None
+
+    return SampleEntry(path, sample_id, group)
+
+
+def read_manifest(manifest_fp):
+    """
+    Lazily read a tab-separated manifest of input samples, yielding a
+    SampleEntry for each line.
+
+    Each line contains the path to an abundance table, and optionally the
+    sample ID (derived from the filename if empty or missing) and a group
+    label. Blank lines, lines starting with '#' and a header (the first
+    remaining line, if it starts with 'path') are skipped. Relative paths
+    are taken relative to the directory containing the manifest.
+
+    :type manifest_fp: str
+    :param manifest_fp: Path to the manifest file.
+    """
+    base_dir = osp.dirname(osp.abspath(manifest_fp))
+    with open(manifest_fp, "rt") as mf:
+        first = True
+        for line in mf:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if first:
+                first = False
+                if fields[0].strip().lower() == "path":
+                    continue
+            fields = [field.strip() for field in fields]
+            fields[0] = osp.join(base_dir, fields[0])
+            yield sample_entry(fields)
+
+
+def shard_entries(entries, shard, nshards):
+    """
+    Yield the entries that belong to one of nshards shards: every nshards-th
+    entry, starting with the (1-based) shard-th one.
+    """
+    for i, entry in enumerate(entries):
+        if i % nshards == shard - 1:
+            yield entry
+
+
+def record_groups(entries, groups):
+    """
+    Pass through a stream of SampleEntry, recording the group of each
+    sample (if it has one) in the groups dict, keyed on sample ID.
+    """
+    for entry in entries:
+        if entry.group:
+            groups[entry.sample_id] = entry.group
+        yield entry
+
+
+def group_metadata(sample_ids, groups):
+    """
+    Return the BIOM sample metadata recording the group of each sample, or
+    None if no sample has a group.
+    """
+    if not groups:
+        return None
+
+    return [{"group": groups.get(sid, "")} for sid in sample_ids]
+
+
+ClarkColumns = namedtuple("ClarkColumns", ["taxids", "names", "lineages", 
+                                           "values"])
+
+
+def read_clark_columns(clark_f, columns=("Count",)):
+    """
+    Read a CLARK abundance table in a single streaming pass, keeping only
+    the TaxID, Name, Lineage and requested value columns. Rows are never
+    turned into dicts and the UNKNOWN entry is skipped.
+
+    :type clark_f: file-like
+    :param clark_f: An open (text mode) result file from estimate_abundance.sh.
+    :type columns: tuple of str
+    :param columns: The value columns to extract. 'Count' is returned as
+                    int64, any of the proportion columns as float64.
+    :rtype: ClarkColumns
+    :return: The TaxIDs as an int64 array, names and lineages as lists of
+             str, and a dict mapping each requested column to its array.
+    """
+    reader = csv.reader(clark_f)
+    header = next(reader, None)
+    if header is None:
+        header = field_names
+    try:
+        tid_i = header.index("TaxID")
+        name_i = header.index("Name")
+        lin_i = header.index("Lineage")
+        val_is = [header.index(col) for col in columns]
+    except ValueError as ve:
+        raise RuntimeError("ERROR: Unrecognized abundance table header: "
+                           "{}".format(ve))
+
+    taxids = []
+    names = []
+    lineages = []
+    values = [[] for _ in columns]
+    for row in reader:
+        if not row or row[tid_i] == "UNKNOWN":
+            continue
+        taxids.append(row[tid_i])
+        names.append(row[name_i])
+        lineages.append(row[lin_i])
+        for vals, val_i in zip(values, val_is):
+            vals.append(row[val_i])
+
+    try:
+        taxids = np.array(taxids, dtype=np.str_).astype(np.int64)
+        values = {col: np.array(vals, dtype=np.str_).astype(
+                            np.int64 if col == "Count" else np.float64)
+                  for col, vals in zip(columns, values)}
+    except ValueError as ve:
+        raise RuntimeError("ERROR: {}".format(ve))
+
+    return ClarkColumns(taxids, names, lineages, values)
+
+
+def _encode_strings(strings):
+    """
+    Encode a list of strings as a string table: an array of the offset of
+    each string in a single UTF-8 byte array (returned as uint8).
+    """
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
 
-        # use the clark abundance table filename as the sample ID
-        sample_id = osp.splitext(osp.split(clark_fp)[1])[0]
 
-        with open(clark_fp, "rt") as cf:
+def _decode_strings(offsets, blob):
+    """
+    Decode a string table (see _encode_strings) to a list of strings.
+    """
+    blob = blob.tobytes()
+
+    return [blob[start:end].decode("utf-8") 
+            for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+class ParseCache(object):
+    """
+    An on-disk cache of parsed CLARK abundance tables.
+
+    Each file's columns (see read_clark_columns) are stored, with all of the
+    value columns, as a compressed .npz file keyed on the file's absolute
+    path, size and modification time, so a changed file is never served 
+    from the cache. Names and lineages are stored as UTF-8 string tables
+    (see _encode_strings).
+    Cached files are evicted least-recently-used first once the cache grows
+    beyond `max_bytes` (see evict).
+    """
+    _keys = {"Count": "count", "Proportion_All(%)": "prop_all",
+             "Proportion_Classified(%)": "prop_classified"}
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not osp.isdir(cache_dir):
             try:
-                cdr = csv.DictReader(cf, fieldnames=field_names)
-                data = [entry for entry in cdr][1:]
+                os.makedirs(cache_dir)
             except OSError as oe:
-                raise RuntimeError("ERROR: {}".format(oe))
+                if not osp.isdir(cache_dir):
+                    raise RuntimeError("ERROR: Unable to create cache "
+                                       "directory: {}".format(oe))
+
+    def _path(self, clark_fp):
+        st = os.stat(clark_fp)
+        key = "{}\0{}\0{}".format(osp.abspath(clark_fp), st.st_size, 
+                                   st.st_mtime)
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+        return osp.join(self.cache_dir, digest + ".npz")
+
+    def contains(self, clark_fp):
+        """
+        Check (without loading it) whether a file is in the cache.
+        """
+        try:
+            return osp.isfile(self._path(clark_fp))
+        except OSError:
+            return False
+
+    def load(self, clark_fp):
+        """
+        Return the cached ClarkColumns for a file, or None if the file has
+        not been cached (or has changed since it was, or the entry is
+        unreadable, in which case the file is parsed again).
+        """
+        cache_fp = self._path(clark_fp)
+        try:
+            with np.load(cache_fp) as npz:
+                cols = ClarkColumns(npz["taxids"], 
+                                    _decode_strings(npz["names_offsets"],
+                                                    npz["names_bytes"]),
+                                    _decode_strings(npz["lineages_offsets"],
+                                                    npz["lineages_bytes"]),
+                                    {col: npz[key] 
+                                     for col, key in self._keys.items()})
+        except (IOError, OSError, EOFError, KeyError, ValueError,
+                zipfile.BadZipfile, zlib.error):
+            return None
+        # mark as recently used (unless the cache is read-only)
+        try:
+            os.utime(cache_fp, None)
+        except OSError:
+            pass
+
+        return cols
+
+    def store(self, clark_fp, cols):
+        """
+        Cache the ClarkColumns (with all value columns) parsed from a file.
+        """
+        cache_fp = self._path(clark_fp)
+        arrays = {key: cols.values[col] for col, key in self._keys.items()}
+        for name in ("names", "lineages"):
+            offsets, blob = _encode_strings(getattr(cols, name))
+            arrays[name + "_offsets"] = offsets
+            arrays[name + "_bytes"] = blob
+        try:
+            fd, tmp_fp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        except (IOError, OSError):
+            # e.g. a read-only shared cache
+            return
+        try:
+            with os.fdopen(fd, "wb") as tmp_f:
+                np.savez_compressed(tmp_f, taxids=cols.taxids, **arrays)
+            os.rename(tmp_fp, cache_fp)
+        except (IOError, OSError):
+            if osp.exists(tmp_fp):
+                os.unlink(tmp_fp)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the total size of the
+        cache is no more than max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith(".npz"):
+                st = os.stat(osp.join(self.cache_dir, fname))
+                entries.append((st.st_mtime, st.st_size, fname))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(osp.join(self.cache_dir, fname))
+            except OSError:
+                break
+            total -= size
+
+
+def _read_sample(clark_fp, store_pct=False, tax_cache=None, 
+                 parse_cache=None, columns=None, data=None):
+    """
+    Read a single CLARK abundance table file (or SampleEntry, see
+    sample_entry), returning the sample ID, an int64 array of the taxon IDs,
+    an array of their values and a list of their taxonomies. If a list of 
+    value columns is given (overriding store_pct), the values are instead a
+    tuple with an array for each of the columns. If a ParseCache is given,
+    the parsed columns are loaded from, or added to, the cache. The contents
+    of the file can be passed as data if they have already been read.
+    """
+    if tax_cache is None:
+        tax_cache = TaxonomyCache()
+
+    clark_fp, sample_id, _ = sample_entry(clark_fp)
+    if not osp.isfile(clark_fp):
+        raise RuntimeError("ERROR: File '{}' not found.".format(clark_fp))
+
+    value_cols = columns
+    if columns is None:
+        value_cols = ("Proportion_Classified(%)" if store_pct else "Count",)
+    cols = parse_cache.load(clark_fp) if parse_cache is not None else None
+    if cols is None:
+        try:
+            with open_clark_file(clark_fp, data) as cf:
+                cols = read_clark_columns(cf, columns=value_fields
+                                              if parse_cache is not None 
+                                              else value_cols)
+        except read_errors as oe:
+            raise RuntimeError("ERROR: {}: {}".format(clark_fp, oe))
+        if parse_cache is not None:
+            parse_cache.store(clark_fp, cols)
+
+    taxonomies = [tax_cache.get(taxid, lineage, name)
+                  for taxid, lineage, name 
+                  in zip(cols.taxids.tolist(), cols.lineages, cols.names)]
+
+    values = tuple(cols.values[col] for col in value_cols)
+
+    return (sample_id, cols.taxids, values if columns is not None 
+            else values[0], taxonomies)
+
+
+# per-process taxonomy and parse caches used by the parsing pool workers
+_worker_tax_cache = None
+_worker_parse_cache = None
+
+
+def _init_parse_worker(cache_dir=None):
+    global _worker_tax_cache, _worker_parse_cache
+    _worker_tax_cache = TaxonomyCache()
+    if cache_dir is not None:
+        _worker_parse_cache = ParseCache(cache_dir)
+
 
-        scounts, staxa = parse_clark_abundance_tbl(data, store_pct=store_pct)
+def _parse_sample_worker(job):
+    """
+    Process pool entry point for parsing a single file. The per-sample counts
+    are returned as NumPy arrays of taxon IDs and values, which are much
+    cheaper to send back to the parent process than a dict. The
+    worker's taxonomy cache hits and misses for the file are also returned.
+    """
+    clark_fp, store_pct, columns = job
+    hits, misses = _worker_tax_cache.hits, _worker_tax_cache.misses
+    result = _read_sample(clark_fp, store_pct, _worker_tax_cache,
+                          _worker_parse_cache, columns)
+
+    return result, (_worker_tax_cache.hits - hits,
+                    _worker_tax_cache.misses - misses)
+
+
+def _parse_samples_parallel(clark_abd_fps, store_pct, jobs, tax_cache,
+                            parse_cache=None, columns=None):
+    """
+    Parse the abundance tables in a pool of worker processes, yielding the
+    results in input order.
+    """
+    try:
+        chunksize = max(1, len(clark_abd_fps) // (jobs * 4))
+    except TypeError:
+        # a stream of inputs, e.g. from a manifest
+        chunksize = 4
+    cache_dir = parse_cache.cache_dir if parse_cache is not None else None
+    pool = multiprocessing.Pool(jobs, initializer=_init_parse_worker,
+                                initargs=(cache_dir,))
+    try:
+        results = pool.imap(_parse_sample_worker,
+                            ((fp, store_pct, columns) for fp in clark_abd_fps),
+                            chunksize=chunksize)
+        for result, (hits, misses) in results:
+            tax_cache.hits += hits
+            tax_cache.misses += misses
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def stream_samples(clark_abd_fps, store_pct=False, jobs=1, tax_cache=None,
+                   parse_cache=None, columns=None, prefetch=0):
+    """
+    Parse the clark abundance tables one at a time, in input order.
+
+    Takes the same arguments as process_samples, but rather than collecting
+    the results, yields a (sample ID, taxon IDs, values, taxonomies) tuple
+    for each file, where the taxon IDs are an int64 array, the values an
+    array aligned with them, and taxonomies a list of their taxonomies (see
+    tax_fmt).
+
+    If a list of value columns (e.g. ["Count", "Proportion_Classified(%)"])
+    is given, all of them are read in the same pass and the values are a
+    tuple of arrays, one per column, instead.
+
+    With a single job, up to `prefetch` upcoming files are read in
+    background threads (see prefetch_files) while the current one is being
+    parsed; files in the parse cache are not read ahead. Samples are 
+    yielded as soon as they are parsed, so a consumer such as 
+    build_sparse_table overlaps with the reading and parsing.
+    """
+    if tax_cache is None:
+        tax_cache = TaxonomyCache()
+
+    if jobs > 1:
+        return _parse_samples_parallel(clark_abd_fps, store_pct, jobs,
+                                       tax_cache, parse_cache, columns)
+
+    if prefetch > 0:
+        return (_read_sample(entry, store_pct, tax_cache, parse_cache, columns,
+                             data)
+                for entry, data in prefetch_files(clark_abd_fps, prefetch,
+                                                  parse_cache.contains 
+                                                  if parse_cache is not None
+                                                  else None))
 
+    return (_read_sample(clark_fp, store_pct, tax_cache, parse_cache, columns)
+            for clark_fp in clark_abd_fps)
+
+
+class TaxonIndex(object):
+    """
+    Interns integer taxon IDs into a dense int32 index, in order of first
+    appearance.
+
+    Whole arrays of taxon IDs are looked up at once through a sorted copy of
+    the known IDs, and the IDs are only converted to strings (for writing)
+    by ids().
+    """
+    def __init__(self):
+        self.taxids = np.empty(0, dtype=np.int64)
+        self._sorted = np.empty(0, dtype=np.int64)
+        self._sorted_idx = np.empty(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.taxids)
+
+    def find(self, taxids):
+        """
+        Look up an array of taxon IDs, returning their indices and a boolean
+        array marking which of them are known (the index of an unknown
+        taxon ID is meaningless).
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+        if not len(self._sorted):
+            return (np.zeros(len(taxids), dtype=np.int32), 
+                    np.zeros(len(taxids), dtype=bool))
+        pos = np.minimum(np.searchsorted(self._sorted, taxids), 
+                         len(self._sorted) - 1)
+
+        return self._sorted_idx[pos], self._sorted[pos] == taxids
+
+    def intern(self, taxids):
+        """
+        Return the int32 indices of an array of taxon IDs, assigning new
+        indices to any that have not been seen before.
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+        idx, found = self.find(taxids)
+        if found.all():
+            return idx
+
+        new, first = np.unique(taxids[~found], return_index=True)
+        new_idx = np.empty(len(new), dtype=np.int32)
+        new_idx[np.argsort(first)] = np.arange(len(self.taxids), 
+                                               len(self.taxids) + len(new))
+        self.taxids = np.concatenate([self.taxids, new[np.argsort(first)]])
+        ins = np.searchsorted(self._sorted, new)
+        self._sorted = np.insert(self._sorted, ins, new)
+        self._sorted_idx = np.insert(self._sorted_idx, ins, new_idx)
+
+        return self.find(taxids)[0]
+
+    def ids(self, idx=None):
+        """
+        Return the taxon IDs (of all, or the given indices) as strings.
+        """
+        taxids = self.taxids if idx is None else self.taxids[idx]
+
+        return [str(taxid) for taxid in taxids.tolist()]
+
+
+class SampleCounts(Mapping):
+    """
+    The counts for a single sample, stored as paired NumPy arrays of taxon
+    index (into a shared TaxonIndex) and value.
+
+    For compatibility with the dict-based API, it is also a read-only
+    mapping of taxon ID (str) -> value, with the lookup table only built if
+    it is used.
+    """
+    __slots__ = ("index", "rows", "counts", "_pos")
+
+    def __init__(self, index, rows, counts):
+        self.index = index
+        self.rows = rows
+        self.counts = counts
+        self._pos = None
+
+    def __getitem__(self, taxid):
+        if self._pos is None:
+            self._pos = {tid: i for i, tid in enumerate(self)}
+
+        return self.counts[self._pos[str(taxid)]].item()
+
+    def __iter__(self):
+        return iter(self.index.ids(self.rows))
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def process_samples(clark_abd_fps, store_pct=False, jobs=1, tax_cache=None,
+                    parse_cache=None, prefetch=0, lineages=None):
+    """
+    Parse all clark abundance tables into sample counts dict
+    and store global taxon id -> taxonomy data
+
+    The counts for each sample are returned as SampleCounts (paired arrays
+    of taxon index and value sharing a single TaxonIndex), which can also be
+    used as a dict of taxon ID -> count. Sample IDs must be unique; a
+    RuntimeError is raised for a duplicate, as with SparseTableBuilder.
+
+    :type clark_abd_fps: iterable
+    :param clark_abd_fps: Paths to the abundance tables, or (path, sample ID)
+                          pairs (see sample_entry and read_manifest).
+
+    :type jobs: int
+    :param jobs: Number of worker processes used to parse the files. The
+                 results are merged in input order, so the output is
+                 identical to parsing with a single process.
+    :type tax_cache: TaxonomyCache
+    :param tax_cache: Cache used to format the taxonomies. A new cache is
+                      created if one is not supplied. With multiple jobs,
+                      each worker keeps its own cache and only the hit/miss
+                      counts are accumulated in this one.
+    :type parse_cache: ParseCache
+    :param parse_cache: If given, unchanged files are loaded from this cache
+                        instead of being parsed, and newly parsed files are
+                        added to it.
+    :type prefetch: int
+    :param prefetch: Number of upcoming files read in the background while
+                     parsing with a single job (see prefetch_files).
+    :type lineages: LineageChecker
+    :param lineages: If given, the taxonomies of each sample are checked 
+                     for taxon IDs with inconsistent lineages. A taxon ID
+                     keeps the taxonomy of the last sample it was found in.
+    """
+    index = TaxonIndex()
+    taxonomy = []
+    sample_counts = OrderedDict()
+
+    samples = stream_samples(clark_abd_fps, store_pct, jobs, tax_cache,
+                             parse_cache, prefetch=prefetch)
+    if lineages is not None:
+        samples = record_lineages(samples, lineages)
+    for sample_id, taxids, values, taxonomies in samples:
+        if sample_id in sample_counts:
+            raise RuntimeError("ERROR: Duplicate sample ID: {}".format(
+                               sample_id))
         # update master records
-        taxa.update(staxa)
-        sample_counts[sample_id] = scounts
+        rows = index.intern(taxids)
+        taxonomy.extend([None] * (len(index) - len(taxonomy)))
+        for row, tax in zip(rows.tolist(), taxonomies):
+            taxonomy[row] = tax
+        sample_counts[sample_id] = SampleCounts(index, rows, values)
+
+    # taxon IDs are only converted back to strings here
+    taxa = OrderedDict(zip(index.ids(), taxonomy))
 
     return sample_counts, taxa
 
 
-def create_biom_table(sample_counts, taxa):
+class SparseTableBuilder(object):
+    """
+    Incrementally assemble a sparse taxa x samples table from a stream of
+    parsed samples (see stream_samples).
+
+    Each sample is appended as a column to a growing compressed sparse
+    column (CSC) store, so only the non-zero entries of the final table are
+    ever held in memory. Taxon IDs are assigned rows in the order they are
+    first seen.
+
+    Several value columns (e.g. counts and proportions) can be assembled at
+    once by giving a list of dtypes, one per column; they share the row
+    index, sample IDs and sparsity structure, and split() returns a builder
+    for each of them.
+    """
+    def __init__(self, dtype="int64", capacity=4096):
+        self.index = TaxonIndex()
+        # taxonomy of each row
+        self.taxonomy = []
+        self.sample_ids = []
+        self._sample_set = set()
+        self._indices = np.empty(capacity, dtype=np.int32)
+        dtypes = dtype if isinstance(dtype, (list, tuple)) else [dtype]
+        self._values = [np.empty(capacity, dtype=dt_) for dt_ in dtypes]
+        self._indptr = [0]
+        # number of samples each row (taxon) occurs in
+        self._prevalence = np.zeros(capacity, dtype=np.int64)
+
+    @property
+    def nnz(self):
+        return self._indptr[-1]
+
+    @property
+    def shape(self):
+        return len(self.index), len(self.sample_ids)
+
+    @property
+    def taxa(self):
+        """Ordered mapping of taxon ID (str) -> taxonomy for the rows."""
+        return OrderedDict(zip(self.index.ids(), self.taxonomy))
+
+    @property
+    def prevalence(self):
+        """The number of samples each row (taxon) occurs in."""
+        return self._prevalence[:len(self.index)]
+
+    def _reserve(self, n):
+        """Grow the index/value arrays (by doubling) to hold n more entries."""
+        needed = self.nnz + n
+        if needed <= len(self._indices):
+            return
+        capacity = max(needed, 2 * len(self._indices))
+        self._indices = np.resize(self._indices, capacity)
+        self._values = [np.resize(data, capacity) for data in self._values]
+
+    def add_sample(self, sample_id, taxids, values, taxonomies):
+        """
+        Append one sample's counts as a new column of the table.
+
+        :type sample_id: str
+        :param sample_id: The ID of the new sample (column).
+        :type taxids: numpy.ndarray
+        :param taxids: The (integer) taxon IDs with non-zero values in the 
+                       sample.
+        :type values: numpy.ndarray
+        :param values: The values for each of the taxon IDs (a tuple of
+                       arrays, one per column, if the builder has several
+                       value columns).
+        :type taxonomies: list
+        :param taxonomies: The taxonomy of each of the taxon IDs.
+        """
+        if sample_id in self._sample_set:
+            raise RuntimeError("ERROR: Duplicate sample ID: {}".format(sample_id))
+
+        rows = self.index.intern(taxids)
+        taxonomy = self.taxonomy
+        taxonomy.extend([None] * (len(self.index) - len(taxonomy)))
+        for row, tax in zip(rows.tolist(), taxonomies):
+            taxonomy[row] = tax
+        if len(self._prevalence) < len(taxonomy):
+            prevalence = np.zeros(max(len(taxonomy), 2 * len(self._prevalence)),
+                                  dtype=np.int64)
+            prevalence[:len(self._prevalence)] = self._prevalence
+            self._prevalence = prevalence
+        self._prevalence[rows] += 1
+
+        n = len(rows)
+        self._reserve(n)
+        start = self.nnz
+        self._indices[start:start+n] = rows
+        if not isinstance(values, tuple):
+            values = (values,)
+        for data, vals in zip(self._values, values):
+            data[start:start+n] = vals
+        self._indptr.append(start + n)
+        self.sample_ids.append(sample_id)
+        self._sample_set.add(sample_id)
+
+    def eliminate_zeros(self):
+        """
+        Remove any explicitly stored zero values, in place. With several
+        value columns, only entries that are zero in all of them are removed.
+        """
+        nnz = self.nnz
+        keep = np.zeros(nnz, dtype=bool)
+        for data in self._values:
+            keep |= data[:nnz] != 0
+        if keep.all():
+            return
+        kept = np.concatenate([[0], np.cumsum(keep)])
+        self._indptr = kept[self._indptr].tolist()
+        self._indices = self._indices[:nnz][keep]
+        self._values = [data[:nnz][keep] for data in self._values]
+
+    def prune(self, min_prevalence):
+        """
+        Remove the rows (taxa) that occur in fewer than min_prevalence 
+        samples, in place. The remaining rows keep their order.
+        """
+        keep = self.prevalence >= min_prevalence
+        if keep.all():
+            return
+        nnz = self.nnz
+        new_row = (np.cumsum(keep) - 1).astype(np.int32)
+        kept = keep[self._indices[:nnz]]
+        self._indptr = np.concatenate([[0], np.cumsum(kept)])[
+                                      self._indptr].tolist()
+        self._indices = new_row[self._indices[:nnz][kept]]
+        self._values = [data[:nnz][kept] for data in self._values]
+        self._prevalence = self.prevalence[keep]
+        self.taxonomy = [tax for tax, kept_row 
+                         in zip(self.taxonomy, keep.tolist()) if kept_row]
+        taxids = self.index.taxids[keep]
+        self.index = TaxonIndex()
+        self.index.intern(taxids)
+
+    def csc_arrays(self):
+        """
+        Return views of the (data, indices, indptr) arrays of the table in
+        compressed sparse column layout (the data of the first value column).
+        """
+        nnz = self.nnz
+
+        return (self._values[0][:nnz], self._indices[:nnz], 
+                np.array(self._indptr, dtype=np.int64))
+
+    def split(self):
+        """
+        Return a SparseTableBuilder for each value column. The builders share
+        the (read-only) row index and structure arrays rather than copying
+        them.
+        """
+        builders = []
+        for data in self._values:
+            builder = SparseTableBuilder.__new__(SparseTableBuilder)
+            builder.__dict__.update(self.__dict__)
+            builder._values = [data]
+            builders.append(builder)
+
+        return builders
+
+    def to_csr(self):
+        """
+        Return the assembled table as a scipy.sparse.csr_matrix.
+        """
+        mtx = sp.csc_matrix(self.csc_arrays(), shape=self.shape).tocsr()
+        mtx.eliminate_zeros()
+
+        return mtx
+
+    def to_table(self, sample_metadata=None):
+        """
+        Return the assembled table as a biom.Table (see create_biom_table).
+        """
+        return _make_table(self.to_csr(), self.taxa, self.sample_ids, 
+                           sample_metadata)
+
+
+def filter_samples(samples, min_count=None, top_n=None):
+    """
+    Pass through a stream of parsed samples (see stream_samples), dropping
+    the entries of each sample with a value below min_count and/or all but
+    its top_n most abundant entries, so they never enter the table. With
+    several value columns, the filters apply to the first.
+    """
+    for sample_id, taxids, values, taxonomies in samples:
+        primary = values[0] if isinstance(values, tuple) else values
+        keep = np.ones(len(primary), dtype=bool)
+        if min_count is not None:
+            keep &= primary >= min_count
+        if top_n is not None and keep.sum() > top_n:
+            # ties are broken in favour of the earlier entries
+            kept = np.flatnonzero(keep)
+            ranked = kept[np.argsort(-primary[kept], kind="mergesort")]
+            keep[ranked[top_n:]] = False
+        if not keep.all():
+            taxids = taxids[keep]
+            if isinstance(values, tuple):
+                values = tuple(vals[keep] for vals in values)
+            else:
+                values = values[keep]
+            taxonomies = [tax for tax, kept_entry 
+                          in zip(taxonomies, keep.tolist()) if kept_entry]
+
+        yield sample_id, taxids, values, taxonomies
+
+
+def count_rows(samples, counts):
+    """
+    Pass through a stream of parsed samples (see stream_samples), adding the
+    number of entries of each sample to counts["rows"].
+    """
+    counts.setdefault("rows", 0)
+    for sample in samples:
+        counts["rows"] += len(sample[1])
+        yield sample
+
+
+def build_sparse_table(samples, dtype="int64"):
+    """
+    Consume a stream of parsed samples (see stream_samples) into a
+    SparseTableBuilder. The per-sample results are discarded as soon as they
+    are added, so peak memory is roughly proportional to the final sparse
+    table rather than to all of the parsed input.
+    """
+    builder = SparseTableBuilder(dtype=dtype)
+    for sample_id, taxids, values, taxonomies in samples:
+        builder.add_sample(sample_id, taxids, values, taxonomies)
+
+    return builder
+
+
+def _array_backed(sample_counts):
+    """
+    Check whether all of the sample counts are SampleCounts sharing a
+    single TaxonIndex (as returned by process_samples).
+    """
+    indexes = set(id(scounts.index) if isinstance(scounts, SampleCounts) 
+                  else None for scounts in sample_counts.values())
+
+    return len(indexes) == 1 and None not in indexes
+
+
+def _sample_arrays_matrix(sample_counts, taxa, dtype):
+    """
+    Vectorized sparse_counts_matrix for SampleCounts: the taxon indices of
+    all samples are mapped to rows (in the order of taxa) with a single
+    array lookup. Taxa not in the taxa mapping are left out of the matrix,
+    and taxa whose IDs are not integers get an empty row.
+    """
+    scounts = list(sample_counts.values())
+    index = scounts[0].index if scounts else TaxonIndex()
+    taxa_ids = np.zeros(len(taxa), dtype=np.int64)
+    numeric = np.zeros(len(taxa), dtype=bool)
+    for row, taxid in enumerate(taxa):
+        try:
+            taxa_ids[row] = int(taxid)
+            numeric[row] = True
+        except ValueError:
+            pass
+    idx, found = index.find(taxa_ids)
+    found &= numeric
+    # taxon index -> matrix row
+    row_of = np.full(len(index), -1, dtype=np.int64)
+    row_of[idx[found]] = np.flatnonzero(found)
+
+    rows = row_of[np.concatenate([sc.rows for sc in scounts] or [[]])
+                  .astype(np.int64)]
+    cols = np.repeat(np.arange(len(scounts)), [len(sc) for sc in scounts])
+    data = np.concatenate([sc.counts for sc in scounts] or 
+                          [[]]).astype(dtype, copy=False)
+    keep = rows >= 0
+
+    mtx = sp.coo_matrix((data[keep], (rows[keep], cols[keep])),
+                     shape=(len(taxa), len(scounts))).tocsr()
+    mtx.eliminate_zeros()
+
+    return mtx
+
+
+def _values_dtype(sample_counts):
+    """
+    Return the dtype needed to hold the values of the sample counts without
+    loss: int64 for counts, or float64 if any of the values are floats
+    (e.g. proportions).
+    """
+    for scounts in sample_counts.values():
+        if isinstance(scounts, SampleCounts):
+            if scounts.counts.dtype.kind == "f":
+                return np.float64
+        elif any(isinstance(value, float) for value in scounts.values()):
+            return np.float64
+
+    return np.int64
+
+
+def sparse_counts_matrix(sample_counts, taxa, dtype=None):
+    """
+    Assemble the per-sample counts into a sparse taxa x samples matrix.
+
+    The (row, column, value) triplets for every recorded count are written
+    into preallocated NumPy arrays, so memory use scales with the number of
+    non-zero entries rather than the full size of the table. Taxa not in
+    the taxa mapping are left out of the matrix.
+
+    :type sample_counts: dict
+    :param sample_counts: A dictionary of dictionaries with the first level
+                          keyed on sample ID, and the second level keyed on
+                          taxon ID with counts as values.
+    :type taxa: dict
+    :param taxa: Taxon IDs (keys) in the order of the matrix rows.
+    :type dtype: numpy dtype
+    :param dtype: The type of the values stored in the matrix. By default,
+                  int64 for counts and float64 for proportions.
+    :rtype: scipy.sparse.csr_matrix
+    :return: A matrix with one row per taxon and one column per sample.
+    """
+    if dtype is None:
+        dtype = _values_dtype(sample_counts)
+    if _array_backed(sample_counts):
+        return _sample_arrays_matrix(sample_counts, taxa, dtype)
+
+    row_idx = {taxid: i for i, taxid in enumerate(taxa)}
+    nnz = sum(len(scounts) for scounts in sample_counts.values())
+
+    rows = np.empty(nnz, dtype=np.int32)
+    cols = np.empty(nnz, dtype=np.int32)
+    data = np.empty(nnz, dtype=dtype)
+
+    pos = 0
+    for col, sid in enumerate(sample_counts):
+        entries = [(row_idx[taxid], value) 
+                   for taxid, value in sample_counts[sid].items() 
+                   if taxid in row_idx]
+        end = pos + len(entries)
+        if entries:
+            rows[pos:end], data[pos:end] = zip(*entries)
+        cols[pos:end] = col
+        pos = end
+
+    mtx = sp.coo_matrix((data[:pos], (rows[:pos], cols[:pos])), 
+                     shape=(len(row_idx), len(sample_counts))).tocsr()
+    mtx.eliminate_zeros()
+
+    return mtx
+
+
+def create_biom_table(sample_counts, taxa, sparse=False, sample_metadata=None,
+                      dtype=None):
     """
     Create a BIOM table from sample counts and taxonomy metadata.
 
@@ -137,24 +1494,278 @@ def create_biom_table(sample_counts, taxa):
     :param taxa: A mapping between the taxon IDs from sample_counts to the
                  full representation of the taxonomy string. The values in
                  this dict will be used as metadata in the BIOM table.
+    :type sparse: bool
+    :param sparse: Assemble the table directly as a sparse matrix (see
+                   sparse_counts_matrix) instead of a dense list of lists.
+    :type sample_metadata: list of dicts
+    :param sample_metadata: Optional metadata (e.g. group) for each sample,
+                            in the order of sample_counts.
+    :type dtype: numpy dtype
+    :param dtype: The type used to assemble the values. Note that 
+                  biom.Table converts the values to float64, so a smaller
+                  type (e.g. int32) only saves memory during assembly. By 
+                  default, int64 for counts and float64 for proportions.
     :rtype: biom.Table
     :return: A BIOM table containing the per-sample taxon counts and full
              taxonomy identifiers as metadata for each taxon.
     """
-    data = [[0 if taxid not in sample_counts[sid] else sample_counts[sid][taxid] 
-              for sid in sample_counts] 
-                for taxid in taxa]
-    data = np.array(data, dtype=int)
+    if dtype is None:
+        dtype = _values_dtype(sample_counts)
+
+    if sparse:
+        data = sparse_counts_matrix(sample_counts, taxa, dtype)
+    elif _array_backed(sample_counts):
+        data = sparse_counts_matrix(sample_counts, taxa, dtype).toarray()
+    else:
+        # fill the matrix a sample at a time, without an intermediate copy
+        row_idx = {taxid: i for i, taxid in enumerate(taxa)}
+        data = np.zeros((len(row_idx), len(sample_counts)), dtype=dtype)
+        for col, scounts in enumerate(sample_counts.values()):
+            entries = [(row_idx[taxid], value) 
+                       for taxid, value in scounts.items() if taxid in row_idx]
+            if entries:
+                rows, values = zip(*entries)
+                data[list(rows), col] = values
+
+    return _make_table(data, taxa, list(sample_counts), sample_metadata,
+                       input_is_dense=not sparse)
+
+
+def _make_table(data, taxa, sample_ids, sample_metadata=None,
+                input_is_dense=False):
+    """
+    Wrap a taxa x samples matrix in a biom.Table with the taxonomy of each
+    taxon as observation metadata.
+    """
     tax_meta = [{'taxonomy': taxa[taxid]} for taxid in taxa]
     
     gen_str = "clark-biom v{} ({})".format(__version__, __url__)
 
-    return Table(data, list(taxa), list(sample_counts), tax_meta, 
+    return biom.Table(data, list(taxa), sample_ids, tax_meta, sample_metadata,
                  type="OTU table", create_date=str(dt.now().isoformat()),
-                 generated_by=gen_str, input_is_dense=True)
+                 generated_by=gen_str, input_is_dense=input_is_dense)
+
+
+def load_table(table_fp):
+    """
+    Load a BIOM table in any of the supported formats (see biom.load_table).
+    """
+    return biom.load_table(table_fp)
+
+
+def table_taxa(biomT):
+    """
+    Return an ordered mapping of the observation IDs of a BIOM table to their
+    taxonomy metadata (an empty list for observations without one).
+    """
+    obs_meta = biomT.metadata(axis="observation")
+    if obs_meta is None:
+        obs_meta = [None] * biomT.shape[0]
+
+    return OrderedDict((obs_id, md['taxonomy'] if md else [])
+                       for obs_id, md in zip(biomT.ids(axis="observation"),
+                                             obs_meta))
 
 
-def write_biom(biomT, output_fp, fmt="hdf5", gzip=False):
+def join_tables(tables):
+    """
+    Join BIOM tables containing different samples into a single table.
+
+    The observation (taxon) axis of the result is the union of the input
+    observation IDs, in order of first occurrence, and the taxonomy metadata
+    for each taxon is taken from its first occurrence. Each table's sparse
+    matrix is remapped onto the combined axes without being densified, so
+    time and memory are proportional to the total number of non-zeros.
+
+    :type tables: list of biom.Table
+    :param tables: The tables to join. Sample IDs must be unique across
+                   all of the tables.
+    :rtype: biom.Table
+    :return: The combined table.
+    """
+    taxa = OrderedDict()
+    # hash index of observation ID -> row in the combined table
+    taxa_rows = {}
+    sample_ids = []
+    sample_meta = []
+    seen_samples = set()
+    rows, cols, data = [], [], []
+
+    for biomT in tables:
+        obs_ids = biomT.ids(axis="observation")
+        row_map = np.empty(len(obs_ids), dtype=np.int64)
+        for i, (obs_id, tax) in enumerate(table_taxa(biomT).items()):
+            if obs_id not in taxa_rows:
+                taxa[obs_id] = tax
+                taxa_rows[obs_id] = len(taxa_rows)
+            row_map[i] = taxa_rows[obs_id]
+
+        for sid in biomT.ids(axis="sample"):
+            if sid in seen_samples:
+                raise RuntimeError("ERROR: Duplicate sample ID: {}".format(sid))
+            seen_samples.add(sid)
+        smeta = biomT.metadata(axis="sample")
+        sample_meta.extend(smeta if smeta is not None 
+                           else [{}] * biomT.shape[1])
+
+        coo = biomT.matrix_data.tocoo()
+        rows.append(row_map[coo.row])
+        cols.append(coo.col.astype(np.int64) + len(sample_ids))
+        data.append(coo.data)
+        sample_ids.extend(biomT.ids(axis="sample"))
+
+    mtx = sp.coo_matrix((np.concatenate(data), 
+                      (np.concatenate(rows), np.concatenate(cols))),
+                     shape=(len(taxa), len(sample_ids))).tocsr()
+
+    # tables may not share the same sample metadata categories
+    categories = set()
+    for md in sample_meta:
+        categories.update(md or {})
+    sample_meta = [{cat: (md or {}).get(cat, "") for cat in sorted(categories)}
+                   for md in sample_meta]
+
+    return _make_table(mtx, taxa, sample_ids, sample_meta)
+
+
+def collapse_ranks(mtx, taxa, sample_ids, collapse, sample_metadata=None):
+    """
+    Collapse a taxa x samples table to higher taxonomic ranks.
+
+    Each taxon is assigned to the group formed by its taxonomy up to (and
+    including) each requested rank. Taxa whose lineage does not reach a rank
+    are grouped under the empty name for the missing ranks (e.g. 'g__'). The
+    aggregation matrices (groups x taxa) for all of the ranks are stacked
+    and applied to the counts with a single sparse matrix product.
+
+    :type mtx: scipy.sparse.spmatrix
+    :param mtx: The taxa x samples matrix of counts.
+    :type taxa: dict
+    :param taxa: Ordered mapping of taxon ID -> taxonomy (see tax_fmt) for
+                 the rows of mtx.
+    :type sample_ids: list of str
+    :param sample_ids: The sample IDs of the columns of mtx.
+    :type collapse: list of str
+    :param collapse: The ranks (from the global 'ranks', e.g. 'g') to
+                     collapse the table to.
+    :rtype: OrderedDict
+    :return: A biom.Table for each requested rank, keyed on the rank. The
+             observation IDs are the ';'-joined taxonomy of each group.
+    """
+    rows = []
+    groups = []
+    offset = 0
+    for rank in collapse:
+        level = ranks.index(rank) + 1
+        empty = [r + "__" for r in ranks[:level]]
+        group_idx = OrderedDict()
+        for tax in taxa.values():
+            key = tuple(tax[:level]) + tuple(empty[len(tax):])
+            if key not in group_idx:
+                group_idx[key] = len(group_idx)
+            rows.append(offset + group_idx[key])
+        groups.append(group_idx)
+        offset += len(group_idx)
+
+    cols = np.tile(np.arange(len(taxa)), len(collapse))
+    agg = sp.coo_matrix((np.ones(len(rows)), (rows, cols)),
+                     shape=(offset, len(taxa))).tocsr()
+    collapsed = agg.dot(mtx.tocsr()).tocsr()
+
+    tables = OrderedDict()
+    start = 0
+    for rank, group_idx in zip(collapse, groups):
+        end = start + len(group_idx)
+        gtaxa = OrderedDict((";".join(key), list(key)) for key in group_idx)
+        tables[rank] = _make_table(collapsed[start:end], gtaxa, sample_ids,
+                                   sample_metadata)
+        start = end
+
+    return tables
+
+
+def collapsed_fp(output_fp, rank):
+    """
+    Return the path for the table collapsed to the given rank, next to
+    the main output (e.g. table.biom -> table.g.biom).
+    """
+    root, ext = osp.splitext(output_fp)
+
+    return "{}.{}{}".format(root, rank, ext)
+
+
+def _gzip_member(block, level):
+    """Compress a block of bytes as a complete, standalone gzip member."""
+    comp = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    return comp.compress(block) + comp.flush()
+
+
+class ParallelGzipWriter(object):
+    """
+    A write-only text file object that compresses its output with a pool of
+    threads.
+
+    Text is collected into blocks that are each compressed (by zlib, which
+    releases the GIL) as an independent gzip member and written in order.
+    The result is a standard multi-member gzip file that gzip, zcat and
+    Python's gzip module read transparently.
+    """
+    def __init__(self, output_fp, threads=None, level=9, block_size=2**20):
+        self.threads = threads or multiprocessing.cpu_count()
+        self.level = level
+        self.block_size = block_size
+        self._f = open(output_fp, "wb")
+        self._pool = ThreadPool(self.threads)
+        self._pending = deque()
+        self._buf = []
+        self._buf_len = 0
+        self._nblocks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _submit(self):
+        block = "".join(self._buf).encode("utf-8")
+        self._buf = []
+        self._buf_len = 0
+        self._pending.append(self._pool.apply_async(_gzip_member, 
+                                                    (block, self.level)))
+        self._nblocks += 1
+        # bound the number of blocks held in memory
+        while len(self._pending) > 2 * self.threads:
+            self._f.write(self._pending.popleft().get())
+
+    def write(self, text):
+        self._buf.append(text)
+        self._buf_len += len(text)
+        if self._buf_len >= self.block_size:
+            self._submit()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if self._f.closed:
+            return
+        try:
+            # an empty file still needs one (empty) gzip member
+            if self._buf or not self._nblocks:
+                self._submit()
+            while self._pending:
+                self._f.write(self._pending.popleft().get())
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._f.close()
+
+
+def write_biom(biomT, output_fp, fmt="hdf5", gzip=False, compress_threads=1,
+               compress_level=9):
     """
     Write the BIOM table to a file.
 
@@ -166,30 +1777,485 @@ def write_biom(biomT, output_fp, fmt="hdf5", gzip=False):
     :type fmt: str
     :param fmt: One of: hdf5, json, tsv. The BIOM version the table will be
                 output (2.x, 1.0, 'classic').
+    :type compress_threads: int
+    :param compress_threads: Number of threads used to gzip JSON and TSV
+                             output (see ParallelGzipWriter).
+    :type compress_level: int
+    :param compress_level: gzip compression level (1-9) for JSON and TSV
+                           output.
     """
     opener = open
-    mode = 'w'
+    kwargs = {"mode": "w"}
     if gzip and fmt != "hdf5":
         if not output_fp.endswith(".gz"):
             output_fp += ".gz"
-        opener = gzip_open
-        mode = 'wt'
+        if compress_threads > 1:
+            opener = ParallelGzipWriter
+            kwargs = {"threads": compress_threads, "level": compress_level}
+        else:
+            opener = gzip_open
+            kwargs = {"mode": "wt", "compresslevel": compress_level}
 
     # HDF5 BIOM files are gzipped by default
     if fmt == "hdf5":
         opener = h5py.File
 
-    with opener(output_fp, mode) as biom_f:
+    with opener(output_fp, **kwargs) as biom_f:
         if fmt == "json":
             biomT.to_json(biomT.generated_by, direct_io=biom_f)
         elif fmt == "tsv":
-            biom_f.write(biomT.to_tsv())
+            # rows are written to the file as they are formatted
+            biomT.to_tsv(direct_io=biom_f)
         else:
             biomT.to_hdf5(biom_f, biomT.generated_by)
 
     return output_fp
 
 
+def _write_chunked(grp, name, arrays, length, dtype, chunk_size, 
+                   compression_level):
+    """
+    Create a 1-D dataset and fill it from an iterable of array chunks.
+    """
+    if length == 0:
+        return grp.create_dataset(name, shape=(0,), dtype=dtype)
+    dset = grp.create_dataset(name, shape=(length,), dtype=dtype,
+                              chunks=(min(chunk_size, length),),
+                              compression="gzip",
+                              compression_opts=compression_level)
+    pos = 0
+    for arr in arrays:
+        dset[pos:pos+len(arr)] = arr
+        pos += len(arr)
+
+    return dset
+
+
+def write_hdf5_direct(builder, output_fp, chunk_size=2**16, 
+                      compression_level=4, sample_metadata=None):
+    """
+    Write a table assembled with SparseTableBuilder directly to a BIOM 2.1
+    (HDF5) file, without first creating a biom.Table.
+
+    The sample (CSC) matrix is written straight from the builder's arrays and
+    the observation (CSR) matrix is written chunk by chunk through a
+    permutation of the entries, so the only extra memory needed is a single
+    index array rather than another full copy of the matrix.
+
+    :type builder: SparseTableBuilder
+    :param builder: The assembled table.
+    :type output_fp: str
+    :param output_fp: Path to the BIOM-format file that will be written.
+    :type chunk_size: int
+    :param chunk_size: Number of entries per HDF5 chunk (and per write).
+    :type compression_level: int
+    :param compression_level: gzip compression level (0-9) for the datasets.
+    :type sample_metadata: list of dicts
+    :param sample_metadata: Optional (string) metadata for each sample.
+    """
+    builder.eliminate_zeros()
+    data, indices, indptr = builder.csc_arrays()
+    nnz = len(data)
+    n_obs, n_samples = builder.shape
+    vlen_str = h5py.special_dtype(vlen=str)
+
+    def chunks(arr, func=None):
+        for start in range(0, len(arr), chunk_size):
+            chunk = arr[start:start+chunk_size]
+            yield chunk if func is None else func(chunk)
+
+    def write_ids(grp, ids):
+        if len(ids):
+            _write_chunked(grp, "ids", chunks(ids), len(ids), vlen_str,
+                           chunk_size, compression_level)
+        else:
+            grp.create_dataset("ids", shape=(0,), data=[])
+
+    with h5py.File(output_fp, "w") as h5f:
+        h5f.attrs["id"] = "No Table ID"
+        h5f.attrs["type"] = "OTU table"
+        h5f.attrs["format-url"] = "http://biom-format.org"
+        h5f.attrs["format-version"] = (2, 1)
+        h5f.attrs["generated-by"] = "clark-biom v{} ({})".format(__version__, 
+                                                                 __url__)
+        h5f.attrs["creation-date"] = dt.now().isoformat()
+        h5f.attrs["shape"] = builder.shape
+        h5f.attrs["nnz"] = nnz
+
+        # observation axis: CSR matrix and taxonomy metadata
+        obs = h5f.create_group("observation")
+        obs.create_group("group-metadata")
+        md = obs.create_group("metadata")
+        taxa = list(builder.taxa.values())
+        width = max([len(tax) for tax in taxa] or [0])
+        if n_obs and width:
+            tax_ds = md.create_dataset("taxonomy", shape=(n_obs, width),
+                                       dtype=vlen_str,
+                                       chunks=(min(chunk_size, n_obs), width),
+                                       compression="gzip",
+                                       compression_opts=compression_level)
+            for start in range(0, n_obs, chunk_size):
+                block = taxa[start:start+chunk_size]
+                tax_ds[start:start+len(block)] = [list(tax) + [""] * 
+                                                  (width - len(tax))
+                                                  for tax in block]
+        write_ids(obs, list(builder.taxa))
+
+        order = np.argsort(indices, kind="mergesort")
+        row_counts = np.bincount(indices, minlength=n_obs)
+        obs_indptr = np.concatenate([[0], np.cumsum(row_counts)])
+        mtx = obs.create_group("matrix")
+        _write_chunked(mtx, "data", chunks(order, lambda o: data[o]), nnz,
+                       np.float64, chunk_size, compression_level)
+        _write_chunked(mtx, "indices", 
+                       chunks(order, lambda o: np.searchsorted(indptr, o, 
+                                                               side="right") - 1),
+                       nnz, np.int32, chunk_size, compression_level)
+        _write_chunked(mtx, "indptr", chunks(obs_indptr), n_obs + 1, np.int32,
+                       chunk_size, compression_level)
+        del order
+
+        # sample axis: CSC matrix straight from the builder
+        smp = h5f.create_group("sample")
+        smp.create_group("group-metadata")
+        md = smp.create_group("metadata")
+        for category in sorted(sample_metadata[0] if sample_metadata else []):
+            md.create_dataset(category, shape=(n_samples,), dtype=vlen_str,
+                              data=[smd[category] for smd in sample_metadata])
+        write_ids(smp, builder.sample_ids)
+        mtx = smp.create_group("matrix")
+        _write_chunked(mtx, "data", chunks(data), nnz, np.float64, chunk_size,
+                       compression_level)
+        _write_chunked(mtx, "indices", chunks(indices), nnz, np.int32, 
+                       chunk_size, compression_level)
+        _write_chunked(mtx, "indptr", chunks(indptr), n_samples + 1, np.int32,
+                       chunk_size, compression_level)
+
+    return output_fp
+
+
+def _save_strings(store_dir, name, strings):
+    """
+    Save a list of strings as a string table: a single UTF-8 byte array and
+    an array of the offset of each string in it.
+    """
+    offsets, blob = _encode_strings(strings)
+    np.save(osp.join(store_dir, name + ".offsets.npy"), offsets)
+    np.save(osp.join(store_dir, name + ".bytes.npy"), blob)
+
+
+def _load_strings(store_dir, name, mmap_mode="r"):
+    """
+    Load a string table saved by _save_strings.
+    """
+    offsets = np.load(osp.join(store_dir, name + ".offsets.npy"), 
+                      mmap_mode=mmap_mode)
+    blob = np.load(osp.join(store_dir, name + ".bytes.npy"), 
+                   mmap_mode=mmap_mode)
+
+    return _decode_strings(offsets, blob)
+
+
+def write_cohort_store(store_dir, mtx, taxa, sample_ids, groups=None,
+                       kind=None):
+    """
+    Save a parsed cohort to a directory of NumPy arrays that can be memory
+    mapped by CohortStore.load: the counts in compressed sparse column layout
+    (data, indices and indptr arrays), string tables of the taxon IDs and
+    their taxonomy, and the sample IDs (and groups) and the kind of values
+    as JSON.
+
+    :type store_dir: str
+    :param store_dir: The directory to write the store to (created if it
+                      doesn't exist).
+    :type mtx: scipy.sparse.spmatrix
+    :param mtx: The taxa x samples counts.
+    :type taxa: dict
+    :param taxa: Ordered mapping of taxon ID -> taxonomy (list of str), one
+                 per row of mtx.
+    :type sample_ids: list
+    :param sample_ids: The sample IDs, one per column of mtx.
+    :type groups: dict
+    :param groups: Optional mapping of sample ID -> group.
+    :type kind: str
+    :param kind: The value column the matrix holds, one of value_kinds.
+    """
+    if not osp.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    mtx = sp.csc_matrix(mtx)
+    mtx.eliminate_zeros()
+    mtx.sort_indices()
+    np.save(osp.join(store_dir, "data.npy"), mtx.data)
+    np.save(osp.join(store_dir, "indices.npy"), mtx.indices)
+    np.save(osp.join(store_dir, "indptr.npy"), mtx.indptr.astype(np.int64))
+    _save_strings(store_dir, "taxids", list(taxa))
+    _save_strings(store_dir, "taxonomy", 
+                  [";".join(tax) for tax in taxa.values()])
+
+    meta = {"format": "clark-biom cohort", "version": 1,
+            "shape": list(mtx.shape), "sample_ids": list(sample_ids),
+            "groups": dict(groups or {}), "values": kind}
+    with open(osp.join(store_dir, "cohort.json"), "w") as out_f:
+        json.dump(meta, out_f)
+
+    return store_dir
+
+
+class CohortStore(object):
+    """
+    A parsed cohort loaded from a store written by write_cohort_store.
+
+    The count arrays are memory mapped, so loading a store is nearly
+    instantaneous and only the parts of the arrays that are used (e.g. the
+    columns of a selection of samples) are read from disk. It provides the
+    same interface as SparseTableBuilder (shape, nnz, taxa, sample_ids,
+    csc_arrays, to_csr and to_table), so it can be written with 
+    write_hdf5_direct or collapsed just like a freshly parsed table.
+    """
+    def __init__(self, taxids, taxonomy, sample_ids, data, indices, indptr,
+                 groups=None, kind=None):
+        self.taxids = taxids
+        self.taxonomy = taxonomy
+        self.sample_ids = sample_ids
+        self.groups = groups if groups is not None else {}
+        # value column held (see value_kinds), None if not recorded
+        self.kind = kind
+        self._data = data
+        self._indices = indices
+        self._indptr = indptr
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode="r"):
+        """
+        Load (memory map) the cohort store in store_dir.
+        """
+        meta_fp = osp.join(store_dir, "cohort.json")
+        if not osp.isfile(meta_fp):
+            raise RuntimeError("ERROR: Not a cohort store: {}".format(store_dir))
+        with open(meta_fp) as meta_f:
+            meta = json.load(meta_f)
+
+        def load(name):
+            return np.load(osp.join(store_dir, name + ".npy"), 
+                           mmap_mode=mmap_mode)
+
+        taxonomy = [tax.split(";") if tax else [] 
+                    for tax in _load_strings(store_dir, "taxonomy", mmap_mode)]
+
+        return cls(_load_strings(store_dir, "taxids", mmap_mode), taxonomy,
+                   meta["sample_ids"], load("data"), load("indices"), 
+                   load("indptr"), meta.get("groups"), meta.get("values"))
+
+    @property
+    def nnz(self):
+        return int(self._indptr[-1])
+
+    @property
+    def shape(self):
+        return len(self.taxids), len(self.sample_ids)
+
+    @property
+    def taxa(self):
+        """Ordered mapping of taxon ID (str) -> taxonomy for the rows."""
+        return OrderedDict(zip(self.taxids, self.taxonomy))
+
+    def eliminate_zeros(self):
+        """
+        Stores never contain explicit zeros (see write_cohort_store).
+        """
+
+    def csc_arrays(self):
+        """
+        Return the (data, indices, indptr) arrays of the table in
+        compressed sparse column layout.
+        """
+        return self._data, self._indices, self._indptr
+
+    def to_csr(self):
+        """
+        Return the table as a scipy.sparse.csr_matrix.
+        """
+        return sp.csc_matrix(self.csc_arrays(), shape=self.shape).tocsr()
+
+    def to_table(self, sample_metadata=None):
+        """
+        Return the table as a biom.Table (see create_biom_table).
+        """
+        return _make_table(self.to_csr(), self.taxa, self.sample_ids, 
+                           sample_metadata)
+
+    def select(self, sample_ids):
+        """
+        Return an (in memory) CohortStore of just the given samples, in the
+        given order. Only the columns of those samples are read.
+        """
+        if getattr(self, "_col_of", None) is None:
+            self._col_of = {sid: col for col, sid in enumerate(self.sample_ids)}
+        try:
+            cols = [self._col_of[sid] for sid in sample_ids]
+        except KeyError as ke:
+            raise RuntimeError("ERROR: Sample ID not found in cohort: "
+                               "{}".format(ke.args[0]))
+        starts = self._indptr[cols] if cols else np.empty(0, dtype=np.int64)
+        ends = self._indptr[np.add(cols, 1)] if cols else starts
+        spans = [slice(start, end) for start, end in zip(starts.tolist(),
+                                                         ends.tolist())]
+        indptr = np.concatenate([[0], np.cumsum(ends - starts)]).astype(np.int64)
+
+        return type(self)(self.taxids, self.taxonomy, list(sample_ids),
+                          np.concatenate([self._data[s] for s in spans] or 
+                                         [self._data[:0]]),
+                          np.concatenate([self._indices[s] for s in spans] or
+                                         [self._indices[:0]]),
+                          indptr,
+                          dict((sid, self.groups[sid]) for sid in sample_ids
+                               if sid in self.groups), self.kind)
+
+
+class Cohort(CohortStore):
+    """
+    A parsed cohort that can be queried for sub-tables by sample ID (glob
+    pattern), sample group and taxonomic clade, e.g.::
+
+        cohort = Cohort.from_samples(*process_samples(fps))
+        biomT = cohort.query(samples="P01-*", clade="p__Firmicutes").to_table()
+
+    The samples are stored column-wise and the taxa are indexed by clade, so
+    the time taken by a query is proportional to the number of non-zero 
+    entries of the selected samples rather than to the whole cohort. A
+    Cohort can also be loaded from a store written by write_cohort_store 
+    (see CohortStore.load).
+    """
+    @classmethod
+    def from_matrix(cls, mtx, taxa, sample_ids, groups=None):
+        """
+        Create a Cohort from a taxa x samples (sparse) matrix, the ordered
+        taxon ID -> taxonomy mapping of its rows and its sample IDs.
+        """
+        mtx = sp.csc_matrix(mtx)
+        mtx.eliminate_zeros()
+        mtx.sort_indices()
+
+        return cls(list(taxa), list(taxa.values()), list(sample_ids), 
+                   mtx.data, mtx.indices, mtx.indptr.astype(np.int64), 
+                   groups)
+
+    @classmethod
+    def from_samples(cls, sample_counts, taxa, groups=None):
+        """
+        Create a Cohort from the results of process_samples.
+        """
+        return cls.from_matrix(sparse_counts_matrix(sample_counts, taxa), 
+                               taxa, list(sample_counts), groups)
+
+    @classmethod
+    def from_builder(cls, builder, groups=None):
+        """
+        Create a Cohort from a SparseTableBuilder (see build_sparse_table),
+        sharing its arrays.
+        """
+        builder.eliminate_zeros()
+        data, indices, indptr = builder.csc_arrays()
+
+        return cls(list(builder.taxa), list(builder.taxonomy), 
+                   list(builder.sample_ids), data, indices, indptr, groups)
+
+    def _clade_index(self):
+        """
+        The per-rank names and integer codes of the taxonomies of the rows
+        (see rank_codes).
+        """
+        if getattr(self, "_clades", None) is None:
+            self._clades = rank_codes(self.taxonomy)
+
+        return self._clades
+
+    def sample_ids_matching(self, samples=None, group=None):
+        """
+        Return the IDs of the samples matching a sample ID glob pattern (or
+        a list of patterns) and/or belonging to a group (or list of groups),
+        in cohort order.
+        """
+        sample_ids = self.sample_ids
+        if samples is not None:
+            patterns = [samples] if isinstance(samples, str) else samples
+            sample_ids = [sid for sid in sample_ids 
+                          if any(fnmatchcase(sid, pattern) 
+                                 for pattern in patterns)]
+        if group is not None:
+            groups = set([group] if isinstance(group, str) else group)
+            sample_ids = [sid for sid in sample_ids 
+                          if self.groups.get(sid) in groups]
+
+        return sample_ids
+
+    def clade_rows(self, clade):
+        """
+        Return the (sorted) rows of the taxa within a clade, given as a
+        rank-prefixed name (e.g. 'p__Firmicutes') or a lineage prefix 
+        (e.g. 'p__Firmicutes;c__Bacilli'). The taxa must be within all of
+        the given clades.
+        """
+        rank_names, codes = self._clade_index()
+        keep = np.ones(len(codes), dtype=bool)
+        for name in clade.split(";"):
+            name = name.strip()
+            rank = name.split("__", 1)[0]
+            if rank not in ranks or "__" not in name:
+                return np.empty(0, dtype=np.int64)
+            level = ranks.index(rank)
+            names = rank_names[level]
+            code = np.searchsorted(names, name)
+            if code == len(names) or names[code] != name:
+                return np.empty(0, dtype=np.int64)
+            keep &= codes[:, level] == code
+
+        return np.flatnonzero(keep).astype(np.int64)
+
+    def query(self, samples=None, group=None, clade=None, drop_empty=True):
+        """
+        Select a sub-table of the cohort.
+
+        :type samples: str or list
+        :param samples: Glob pattern(s) matched against the sample IDs 
+                        (e.g. 'P01-*').
+        :type group: str or list
+        :param group: Only include samples from the given group(s).
+        :type clade: str
+        :param clade: Only include the taxa within this clade (see 
+                      clade_rows).
+        :type drop_empty: bool
+        :param drop_empty: Leave out the taxa without any non-zero values in
+                           the selected samples.
+        :rtype: Cohort
+        :return: The selected samples and taxa, in cohort order.
+        """
+        sub = self.select(self.sample_ids_matching(samples, group))
+        data, indices, indptr = sub.csc_arrays()
+
+        keep_row = np.ones(len(self.taxids), dtype=bool)
+        if clade is not None:
+            keep_row[:] = False
+            keep_row[self.clade_rows(clade)] = True
+        if drop_empty:
+            present = np.zeros(len(self.taxids), dtype=bool)
+            present[indices] = True
+            keep_row &= present
+        if keep_row.all():
+            return sub
+
+        keep = keep_row[indices]
+        new_row = (np.cumsum(keep_row) - 1).astype(indices.dtype)
+        rows = np.flatnonzero(keep_row).tolist()
+
+        return type(self)([self.taxids[row] for row in rows], 
+                          [self.taxonomy[row] for row in rows],
+                          sub.sample_ids, data[keep], new_row[indices[keep]],
+                          np.concatenate([[0], np.cumsum(keep)])[indptr],
+                          sub.groups)
+
+
 def write_otu_file(otu_ids, fp):
     """
     Write out a file containing only the list of OTU IDs from the CLARK
@@ -209,13 +2275,145 @@ def write_otu_file(otu_ids, fp):
         outf.write('\n'.join(otu_ids))
 
 
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the process to its current value.
+    Only supported on Linux; elsewhere the peak is never reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_f:
+            clear_f.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of the process in MB (since the last
+    reset_peak_rss on Linux), or None if it cannot be determined.
+    """
+    try:
+        with open("/proc/self/status") as status_f:
+            for line in status_f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (IOError, OSError):
+        pass
+    if HAVE_RESOURCE:
+        # kilobytes on Linux, bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / (2**20 if sys.platform == "darwin" else 1024)
+
+    return None
+
+
+class PipelineStats(object):
+    """
+    Record the wall time, CPU time (including any worker processes) and peak
+    RSS of each stage of the pipeline, along with stage specific counters
+    such as rows parsed or bytes written.
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing a stage. Yields the (ordered) dict recording
+        the stage, to which counters can be added.
+        """
+        record = OrderedDict()
+        reset_peak_rss()
+        cpu_start = sum(os.times()[:4])
+        start = time.time()
+        yield record
+        wall = time.time() - start
+        record["wall_s"] = round(wall, 4)
+        record["cpu_s"] = round(sum(os.times()[:4]) - cpu_start, 4)
+        peak = peak_rss_mb()
+        record["peak_rss_mb"] = round(peak, 1) if peak is not None else None
+        for key, rate_key in [("files", "files_per_s"), 
+                              ("rows_parsed", "rows_per_s")]:
+            if key in record:
+                record[rate_key] = round(record[key] / wall, 1) if wall else None
+        self.stages[name] = record
+
+    def to_json(self, fp):
+        """
+        Write the recorded stages to a JSON file.
+        """
+        with open(fp, "w") as out_f:
+            json.dump({"version": __version__, "stages": self.stages}, out_f,
+                      indent=2)
+
+    def summary(self):
+        """
+        Return a human readable table of the recorded stages.
+        """
+        lines = ["{:<20} {:>10} {:>10} {:>12}".format("Stage", "Wall (s)", 
+                                                      "CPU (s)", "Peak RSS (MB)")]
+        for name, record in self.stages.items():
+            lines.append("{:<20} {:>10.3f} {:>10.3f} {:>12}".format(
+                         name, record["wall_s"], record["cpu_s"], 
+                         record["peak_rss_mb"]))
+
+        return "\n".join(lines)
+
+
+def shard_spec(arg):
+    """
+    Parse a shard specification of the form I/N (argparse type).
+    """
+    try:
+        shard, nshards = [int(val) for val in arg.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Shard must be given as I/N, "
+                                         "e.g. 1/4")
+    if not 1 <= shard <= nshards:
+        raise argparse.ArgumentTypeError("Shard I/N must have 1 <= I <= N")
+
+    return shard, nshards
+
+
+def rank_list(arg):
+    """
+    Parse a comma-separated list of taxonomic rank letters (argparse type).
+    """
+    collapse = [rank.strip() for rank in arg.split(",") if rank.strip()]
+    for rank in collapse:
+        if rank not in ranks:
+            raise argparse.ArgumentTypeError("Unknown rank '{}', must be "
+                                             "one of: {}".format(rank, 
+                                                                 ",".join(ranks)))
+
+    return collapse
+
+
+def value_list(arg):
+    """
+    Parse a comma-separated list of value column names (argparse type).
+    """
+    kinds = [kind.strip() for kind in arg.split(",") if kind.strip()]
+    for kind in kinds:
+        if kind not in value_kinds:
+            raise argparse.ArgumentTypeError("Unknown value column '{}', must "
+                                             "be one of: {}".format(kind, 
+                                                   ",".join(value_kinds)))
+    if not kinds or len(set(kinds)) != len(kinds):
+        raise argparse.ArgumentTypeError("Value columns must be given once "
+                                         "each: {}".format(arg))
+
+    return kinds
+
+
 def handle_program_options():
     descr = """\
     Create BIOM-format tables (http://biom-format.org) from CLARK output 
     (http://clark.cs.ucr.edu/).
 
     The program takes as input, one or more files output from CLARK's 
-    estimate_abundance tool. Each file is parsed and the counts for each OTU 
+    estimate_abundance tool (optionally compressed with gzip, bzip2 or xz).
+    Each file is parsed and the counts for each OTU 
     (operational taxonomic unit) are recorded, along with database ID (e.g. NCBI), 
     and lineage. The extracted data are then stored in a BIOM table where each count
     is linked to the Sample and OTU it belongs to. Sample IDs are extracted from the
@@ -253,6 +2451,12 @@ def handle_program_options():
 
         $ clark-biom groupA/*.csv groupB/*.csv -o groupsAB.biom
 
+       or list the files (with sample IDs and groups) in a manifest, and
+       process the cohort in two shards::
+
+        $ clark-biom --manifest cohort.tsv --shard 1/2 -o shard1.biom
+        $ clark-biom --manifest cohort.tsv --shard 2/2 -o shard2.biom
+
     3. BIOM v1.0 output::
 
         $ clark-biom S1.csv S2.csv --fmt json
@@ -265,20 +2469,51 @@ def handle_program_options():
 
       Produces a TSV file: table.tsv.gz
 
+    5. Merge tables created for different sets of samples::
+
+        $ clark-biom merge shard1.biom shard2.biom -o table.biom
+
+      See 'clark-biom merge -h' for details.
+
+    6. Save the parsed cohort once and create further outputs from it::
+
+        $ clark-biom --manifest cohort.tsv --dump-cohort cohort.d
+        $ clark-biom --from-cohort cohort.d --fmt tsv -o table.tsv
+
+    7. Keep the parsed samples in memory and build tables on request::
+
+        $ clark-biom serve --socket /tmp/clark-biom.sock --manifest pool.tsv
+
+      See 'clark-biom serve -h' for details.
+
 
     Program arguments
     -----------------"""
 
     parser = argparse.ArgumentParser(description=twdd(descr),
                         formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('clark_abd_tbls', nargs='+', metavar="TABLE-FILE",
+    parser.add_argument('clark_abd_tbls', nargs='*', metavar="TABLE-FILE",
                         help="Result file from estimate_abundance.sh.")
+    parser.add_argument('--manifest', metavar="MANIFEST-FILE",
+                        help="A tab-separated file listing the input files, "
+                             "one per line, as: path, sample ID (optional, "
+                             "derived from the filename by default) and "
+                             "group (optional, stored as the 'group' sample "
+                             "metadata). Relative paths are taken relative "
+                             "to the manifest's directory. Can be used "
+                             "instead of, or as well as, TABLE-FILE.")
+    parser.add_argument('--shard', type=shard_spec, metavar="I/N",
+                        help="Only process the I-th of N shards of the input "
+                             "samples (every N-th sample, starting with the "
+                             "I-th), e.g. to split a large cohort across "
+                             "cluster nodes. The resulting tables can be "
+                             "combined with 'clark-biom merge'.")
     parser.add_argument('-o', '--output_fp', default="table.biom",
                         metavar="COMBINED-OUTPUT-FILE",
                         help="Path to the BIOM-format file. By default, the "
                         "table will be in the HDF5 BIOM 2.x format. Users can "
                         "output to a different format using the --fmt option. "
-                        "The output can also be gzipped using the --gzip"
+                        "The output can also be gzipped using the --gzip "
                         "option. Default path is: ./table.biom")
     parser.add_argument('--otu-fp', dest="otu_fp", metavar="OTU-FILE",
                         help="Create a file containing just (NCBI) OTU IDs "
@@ -295,12 +2530,150 @@ def handle_program_options():
                         help="Record the relative abundances "
                              "('Proportion_Classified' column) instead of "
                              "the raw count ('Count' column) data.")
+    parser.add_argument('--values', type=value_list, metavar="COLUMNS",
+                        help="Record several of the value columns in a "
+                             "single pass over the input files, given as a "
+                             "comma-separated list from: count ('Count'), "
+                             "pct ('Proportion_Classified') and pct_all "
+                             "('Proportion_All'). The first is written to "
+                             "the output file and each of the others to a "
+                             "table next to it, e.g. 'count,pct' writes "
+                             "table.biom and table.pct.biom. Replaces "
+                             "--store-pct.")
+    parser.add_argument('--dtype', choices=["int32", "int64", "float32", 
+                                            "float64"],
+                        help="The type used to assemble the table values; "
+                             "integer types can only be used for counts. "
+                             "int32 and float32 halve the memory of the "
+                             "assembly arrays, but BIOM tables hold float64 "
+                             "values, so the saving only carries through to "
+                             "the output when the table is written directly "
+                             "to HDF5 (see --hdf5-chunk-size); otherwise a "
+                             "float64 copy is made. Default is int64 for "
+                             "counts and float64 for proportions.")
     parser.add_argument('--gzip', action='store_true',
                         help="Compress the output BIOM table with gzip. "
                               "HDF5 BIOM (v2.x) files are internally "
                               "compressed by default, so this option "
                               "is not needed when specifying --fmt hdf5.")
-
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of processes used to parse the "
+                             "abundance tables. Default is 1.")
+    parser.add_argument('--prefetch', type=int, default=0, metavar="N",
+                        help="Read up to N upcoming input files in "
+                             "background threads while the current one is "
+                             "being parsed. Useful when the files are on a "
+                             "network file system. Only used with a single "
+                             "job (see --jobs). Default is 0 (no "
+                             "prefetching).")
+    parser.add_argument('--compress-threads', dest="compress_threads", 
+                        type=int, default=1, metavar="N",
+                        help="Number of threads used to compress the output "
+                             "with --gzip. With more than one thread, the "
+                             "output is written as a multi-member gzip file "
+                             "(readable by gzip/zcat as usual). Default is 1.")
+    parser.add_argument('--compress-level', dest="compress_level", type=int,
+                        choices=range(1, 10), metavar="1-9",
+                        help="gzip compression level of JSON and TSV tables "
+                             "written with --gzip. Lower levels are faster. "
+                             "Default is 9.")
+    parser.add_argument('--collapse-ranks', dest="collapse_ranks", 
+                        type=rank_list, metavar="RANKS",
+                        help="Also write tables with the counts collapsed "
+                             "(summed) to each of these taxonomic ranks, "
+                             "given as a comma-separated list of rank "
+                             "letters from: {}. For example, 'g,f,p' writes "
+                             "genus, family and phylum tables next to the "
+                             "output file (table.g.biom, table.f.biom, "
+                             "table.p.biom).".format(",".join(ranks)))
+    parser.add_argument('--append-to', dest="append_to", metavar="BIOM-FILE",
+                        help="Add the samples from the given abundance "
+                             "tables to an existing BIOM table (e.g. one "
+                             "previously created by clark-biom). Only the "
+                             "new files are parsed; the combined table is "
+                             "written to the output path.")
+    parser.add_argument('--cache-dir', dest="cache_dir", metavar="DIR",
+                        help="Cache the parsed abundance tables in this "
+                             "directory. Input files that have not changed "
+                             "(same path, size and modification time) since "
+                             "they were cached are not parsed again.")
+    parser.add_argument('--cache-size', dest="cache_size", type=float,
+                        default=1024, metavar="MB",
+                        help="Maximum size of the --cache-dir directory. The "
+                             "least recently used entries are removed once "
+                             "the cache is larger than this. Default is "
+                             "1024 MB.")
+    parser.add_argument('--dump-cohort', dest="dump_cohort", metavar="DIR",
+                        help="Also save the parsed cohort to a directory of "
+                             "binary (NumPy) arrays, which can be loaded "
+                             "again with --from-cohort to write further "
+                             "outputs without parsing the input files.")
+    parser.add_argument('--from-cohort', dest="from_cohort", metavar="DIR",
+                        help="Create the outputs from a cohort saved with "
+                             "--dump-cohort instead of from input files. The "
+                             "saved arrays are memory mapped rather than "
+                             "read into memory. The tables hold the values "
+                             "the cohort was saved with (see --values).")
+    parser.add_argument('--stream', action='store_true',
+                        help="Add each sample to a sparse table as soon as "
+                             "it is parsed instead of first collecting all "
+                             "of the parsed samples, keeping peak memory "
+                             "use roughly proportional to the size of the "
+                             "final (sparse) table. Implies --sparse.")
+    parser.add_argument('--hdf5-chunk-size', dest="hdf5_chunk_size", 
+                        type=int, metavar="N",
+                        help="When the table is written directly to the "
+                             "HDF5 file (--fmt hdf5 with --stream, several "
+                             "--values, a filtering option or --from-cohort "
+                             "and without --append-to), write it in chunks of "
+                             "this many entries. Default is 65536.")
+    parser.add_argument('--hdf5-compression-level', 
+                        dest="hdf5_compression_level", type=int, 
+                        choices=range(10), metavar="0-9",
+                        help="gzip compression level of the datasets when the "
+                             "table is written directly to the HDF5 file "
+                             "(see --hdf5-chunk-size). Default is 4.")
+    parser.add_argument('--min-count', dest="min_count", type=float,
+                        metavar="N",
+                        help="Leave out the entries of each sample with a "
+                             "value (count, or proportion with --store-pct) "
+                             "below N.")
+    parser.add_argument('--top-n-per-sample', dest="top_n", type=int,
+                        metavar="N",
+                        help="Only keep the N most abundant taxa of each "
+                             "sample.")
+    parser.add_argument('--min-prevalence', dest="min_prevalence", 
+                        type=float, metavar="N",
+                        help="Leave out the taxa found in fewer than N "
+                             "samples (after --min-count and "
+                             "--top-n-per-sample are applied), or in less "
+                             "than this fraction of the samples if N is "
+                             "below 1.")
+    parser.add_argument('--lineage-report', dest="lineage_report", 
+                        metavar="PATH",
+                        help="Write the taxon IDs given different lineages "
+                             "by different samples, along with the samples "
+                             "giving each lineage, to this tab-separated "
+                             "file (for the lineage a taxon ID had first, "
+                             "only its first sample and those after the "
+                             "first difference are listed). The table keeps "
+                             "the lineage of the last sample each taxon ID "
+                             "is found in.")
+    parser.add_argument('--sparse', action='store_true',
+                        help="Assemble the table as a sparse matrix so that "
+                             "memory use scales with the number of non-zero "
+                             "counts instead of the number of taxa times the "
+                             "number of samples. Recommended for large, "
+                             "sparse cohorts.")
+
+
+    parser.add_argument('--profile', action='store_true',
+                        help="Print the wall time, CPU time and peak memory "
+                             "use of each stage of the program.")
+    parser.add_argument('--stats-json', dest="stats_json", metavar="PATH",
+                        help="Write per-stage timing, memory and throughput "
+                             "statistics (rows parsed, files/sec, bytes "
+                             "written) to this file as JSON.")
 
     parser.add_argument('--version', action='version',                    
              version="clark-biom version {}, {}".format(__version__, __url__))
@@ -308,10 +2681,518 @@ def handle_program_options():
                         help="Prints status messages during program "
                              "execution.")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if args.from_cohort:
+        if args.clark_abd_tbls or args.manifest:
+            parser.error("--from-cohort cannot be combined with input files.")
+    elif not args.clark_abd_tbls and not args.manifest:
+        parser.error("No input files given (TABLE-FILE, --manifest or "
+                     "--from-cohort).")
+    if args.manifest and not osp.isfile(args.manifest):
+        parser.error("Manifest file not found: {}".format(args.manifest))
+    if args.values and args.store_pct:
+        parser.error("--values cannot be combined with --store-pct.")
+    if args.values and len(args.values) > 1:
+        if args.append_to:
+            parser.error("--append-to can only be used with a single value "
+                         "column.")
+        if args.from_cohort:
+            parser.error("A cohort store contains a single value column.")
+    kinds = args.values or (["pct"] if args.store_pct else ["count"])
+    if args.dtype and args.dtype.startswith("int") and kinds != ["count"]:
+        parser.error("--dtype {} can only be used for counts.".format(
+                     args.dtype))
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer.")
+    if args.prefetch < 0:
+        parser.error("--prefetch must not be negative.")
+    if args.top_n is not None and args.top_n < 1:
+        parser.error("--top-n-per-sample must be a positive integer.")
+    if args.min_prevalence is not None and args.min_prevalence < 0:
+        parser.error("--min-prevalence must not be negative.")
+    args.filter = (args.min_count is not None or args.top_n is not None or
+                   args.min_prevalence is not None)
+    if args.filter and args.from_cohort:
+        parser.error("The filtering options cannot be used with "
+                     "--from-cohort.")
+    if args.lineage_report and args.from_cohort:
+        parser.error("--lineage-report cannot be used with --from-cohort.")
+    if args.dtype and args.from_cohort:
+        parser.error("--dtype cannot be used with --from-cohort (the values "
+                     "keep the type they were saved with).")
+    if args.compress_threads < 1:
+        parser.error("--compress-threads must be a positive integer.")
+    if not args.gzip and (args.compress_level is not None or 
+                          args.compress_threads > 1):
+        parser.error("--compress-level and --compress-threads can only be "
+                     "used with --gzip.")
+    # the streaming builder writes HDF5 tables directly (see main)
+    args.direct_hdf5 = (args.fmt == "hdf5" and not args.append_to and 
+                        bool(args.from_cohort or args.stream or 
+                             len(kinds) > 1 or args.filter))
+    if not args.direct_hdf5 and (args.hdf5_chunk_size is not None or
+                                 args.hdf5_compression_level is not None):
+        parser.error("--hdf5-chunk-size and --hdf5-compression-level only "
+                     "apply when the table is written directly to HDF5 "
+                     "(--fmt hdf5 with --stream, several --values, a "
+                     "filtering option or --from-cohort, and without "
+                     "--append-to).")
+    if args.hdf5_chunk_size is not None and args.hdf5_chunk_size < 1:
+        parser.error("--hdf5-chunk-size must be a positive integer.")
+    if args.compress_level is None:
+        args.compress_level = 9
+    if args.hdf5_chunk_size is None:
+        args.hdf5_chunk_size = 2**16
+    if args.hdf5_compression_level is None:
+        args.hdf5_compression_level = 4
+
+    return args
+
+
+def handle_merge_options(argv):
+    descr = """\
+    Merge BIOM tables created by clark-biom for different samples (e.g. one
+    per shard of a cohort, see --shard) into a single table.
+
+    The taxa (rows) of the merged table are the union of the taxa in the
+    input tables, with the taxonomy metadata taken from the first table each
+    taxon appears in. Sample IDs must be unique across the input tables.
+
+    Usage example
+    -------------
+
+        $ clark-biom merge shard1.biom shard2.biom -o table.biom
+
+
+    Program arguments
+    -----------------"""
+
+    parser = argparse.ArgumentParser(prog="clark-biom merge", 
+                        description=twdd(descr),
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('biom_tbls', nargs='+', metavar="BIOM-FILE",
+                        help="BIOM table (any format) to merge.")
+    parser.add_argument('-o', '--output_fp', default="table.biom",
+                        metavar="MERGED-OUTPUT-FILE",
+                        help="Path to the merged BIOM-format file. Default "
+                             "path is: ./table.biom")
+    parser.add_argument('--fmt', default="hdf5", 
+                        choices=["hdf5", "json", "tsv"],
+                        help="Set the output format of the BIOM table. "
+                              "Default is HDF5.")
+    parser.add_argument('--gzip', action='store_true',
+                        help="Compress the output BIOM table with gzip "
+                             "(JSON and TSV formats only).")
+    parser.add_argument('--compress-threads', dest="compress_threads", 
+                        type=int, default=1, metavar="N",
+                        help="Number of threads used to compress the output "
+                             "with --gzip. Default is 1.")
+    parser.add_argument('--compress-level', dest="compress_level", type=int,
+                        choices=range(1, 10), metavar="1-9",
+                        help="gzip compression level used with --gzip. "
+                             "Default is 9.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Prints status messages during program "
+                             "execution.")
+
+    args = parser.parse_args(argv)
+
+    for fp in args.biom_tbls:
+        if not osp.isfile(fp):
+            parser.error("File not found: {}".format(fp))
+    if args.compress_threads < 1:
+        parser.error("--compress-threads must be a positive integer.")
+    if not args.gzip and (args.compress_level is not None or 
+                          args.compress_threads > 1):
+        parser.error("--compress-level and --compress-threads can only be "
+                     "used with --gzip.")
+    if args.compress_level is None:
+        args.compress_level = 9
+
+    return args
+
+
+def merge_main(argv):
+    args = handle_merge_options(argv)
+
+    if args.fmt == 'hdf5' and not HAVE_H5PY:
+        args.fmt = 'json'
+        msg = """\
+        Library 'h5py' not found, unable to write BIOM 2.x (HDF5) files.
+        Defaulting to BIOM 1.0 (JSON)."""
+        print(twdd(msg))
+
+    # tables are loaded one at a time, only their non-zeros are kept
+    try:
+        biomT = join_tables(load_table(fp) for fp in args.biom_tbls)
+    except (IOError, RuntimeError, TypeError, ValueError) as err:
+        sys.exit("ERROR merging tables: \n\t{}".format(err))
+
+    out_fp = write_biom(biomT, args.output_fp, args.fmt, args.gzip,
+                        compress_threads=args.compress_threads,
+                        compress_level=args.compress_level)
+
+    if args.verbose:
+        table_str = """\
+        Merged {n} tables into: {out_fp}
+        Table contains {rows} rows (OTUs) and {cols} columns (Samples)
+        and is {density:.1%} dense.""".format(n=len(args.biom_tbls),
+                                              out_fp=out_fp, 
+                                              rows=biomT.shape[0], 
+                                              cols=biomT.shape[1],
+                                              density=biomT.get_table_density())
+        print(twdd(table_str))
+
+
+class SampleIndex(object):
+    """
+    A warm, in-memory index of parsed abundance tables, used by the server
+    mode (see serve_main) to build tables for any subset of samples without
+    parsing the files again.
+
+    Each file is parsed once, with all of its value columns, and is parsed
+    again only if its size or modification time changes.
+    """
+    def __init__(self):
+        self.tax_cache = TaxonomyCache()
+        # absolute path -> ((size, mtime), taxids, values, taxonomies)
+        self._samples = {}
+        self.parsed = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def get(self, clark_fp):
+        """
+        Return the parsed (taxon IDs, values, taxonomies) of a file, where
+        the values are a tuple with an array for each of value_fields.
+        """
+        path = osp.abspath(clark_fp)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._samples.pop(path, None)
+            raise RuntimeError("ERROR: File '{}' not found.".format(clark_fp))
+        key = (st.st_size, st.st_mtime)
+
+        cached = self._samples.get(path)
+        if cached is None or cached[0] != key:
+            _, taxids, values, taxonomies = _read_sample(path, 
+                                                 tax_cache=self.tax_cache,
+                                                 columns=value_fields)
+            cached = (key, taxids, values, taxonomies)
+            self._samples[path] = cached
+            self.parsed += 1
+        else:
+            self.hits += 1
+
+        return cached[1:]
+
+    def build(self, samples, kind="count", dtype=None):
+        """
+        Assemble a table from the indexed samples.
+
+        :type samples: iterable
+        :param samples: Paths to the abundance tables, or (path, sample ID[,
+                        group]) sequences (see sample_entry).
+        :type kind: str
+        :param kind: The value column to use, one of value_kinds.
+        :type dtype: numpy dtype
+        :param dtype: The type of the values (by default, int64 for counts
+                      and float64 for proportions).
+        :rtype: tuple
+        :return: A SparseTableBuilder with the table, and the groups of the
+                 samples keyed on sample ID.
+        """
+        if kind not in value_kinds:
+            raise RuntimeError("ERROR: Unknown value column '{}', must be one "
+                               "of: {}".format(kind, ",".join(value_kinds)))
+        col = value_fields.index(value_kinds[kind])
+        if dtype is None:
+            dtype = "int64" if kind == "count" else "float64"
+
+        groups = OrderedDict()
+        builder = SparseTableBuilder(dtype=dtype)
+        for entry in record_groups((sample_entry(item) for item in samples), 
+                                   groups):
+            taxids, values, taxonomies = self.get(entry.path)
+            builder.add_sample(entry.sample_id, taxids, values[col], 
+                               taxonomies)
+
+        return builder, groups
+
+    def stats(self):
+        return OrderedDict([("samples", len(self)), ("parsed", self.parsed),
+                            ("hits", self.hits)])
+
+
+def _serve_samples(samples):
+    """
+    Check the samples of a build request: a non-empty list of paths or of 
+    [path, sample ID[, group]] lists.
+    """
+    if not samples:
+        raise RuntimeError("ERROR: No samples given.")
+    if not isinstance(samples, list):
+        raise RuntimeError("ERROR: 'samples' must be a list.")
+    for item in samples:
+        if isinstance(item, str):
+            continue
+        if (not isinstance(item, list) or not 1 <= len(item) <= 3 or 
+                not all(isinstance(field, str) for field in item)):
+            raise RuntimeError("ERROR: Invalid sample: {}, must be a path or "
+                               "a [path, sample ID, group] list of "
+                               "strings.".format(json.dumps(item)))
+
+    return samples
+
+
+def _serve_output_fp(output_fp, output_dir):
+    """
+    Resolve the output path of a build request within the server's output
+    directory, refusing paths outside of it (or any path if the server has
+    no output directory).
+    """
+    if output_dir is None:
+        raise RuntimeError("ERROR: Writing tables is disabled, start the "
+                           "server with --output-dir to allow it.")
+    if not isinstance(output_fp, str) or not output_fp:
+        raise RuntimeError("ERROR: 'output' must be a path.")
+    out_fp = osp.realpath(osp.join(output_dir, output_fp))
+    if not out_fp.startswith(osp.join(output_dir, "")):
+        raise RuntimeError("ERROR: Output path '{}' is outside of the output "
+                           "directory.".format(output_fp))
+
+    return out_fp
+
+
+def _serve_build(index, request, output_dir=None):
+    """
+    Handle a table build request (a dict, see handle_serve_options), 
+    returning the response body and its content type. Tables are only 
+    written to files within output_dir (a real path).
+    """
+    if not isinstance(request, dict):
+        raise RuntimeError("ERROR: The request must be a JSON object.")
+    samples = _serve_samples(request.get("samples"))
+    fmt = request.get("fmt", "hdf5")
+    if fmt not in ("hdf5", "json", "tsv"):
+        raise RuntimeError("ERROR: Unknown format: {}".format(fmt))
+    output_fp = request.get("output")
+    if output_fp is None and fmt == "hdf5":
+        raise RuntimeError("ERROR: HDF5 tables can only be written to a "
+                           "file (give an 'output' path).")
+    if output_fp is not None:
+        output_fp = _serve_output_fp(output_fp, output_dir)
+    if fmt == "hdf5" and not HAVE_H5PY:
+        raise RuntimeError("ERROR: Library 'h5py' not found, unable to write "
+                           "BIOM 2.x (HDF5) files.")
+    kind = request.get("values", "count")
+    if not isinstance(kind, str):
+        raise RuntimeError("ERROR: 'values' must be a string.")
+
+    builder, groups = index.build(samples, kind)
+    sample_meta = group_metadata(builder.sample_ids, groups)
+
+    if output_fp is None:
+        biomT = builder.to_table(sample_meta)
+        if fmt == "json":
+            return biomT.to_json("clark-biom"), "application/json"
+        return biomT.to_tsv(), "text/tab-separated-values"
+
+    if fmt == "hdf5":
+        out_fp = write_hdf5_direct(builder, output_fp, 
+                                   sample_metadata=sample_meta)
+    else:
+        out_fp = write_biom(builder.to_table(sample_meta), output_fp, fmt,
+                            request.get("gzip", False))
+    response = OrderedDict([("output", out_fp), ("shape", builder.shape),
+                            ("nnz", builder.nnz)])
+
+    return json.dumps(response), "application/json"
+
+
+def make_server(index, address, verbose=False, output_dir=None):
+    """
+    Create the HTTP server for the server mode, listening on a Unix socket
+    (if address is a path) or a TCP (host, port) address. Tables are only
+    written to files within output_dir (none if not given).
+
+    http.server is only imported here, as it noticeably slows down the 
+    start-up of the other modes.
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        import socketserver
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        import SocketServer as socketserver
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body, content_type="application/json"):
+            body = body.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, code, msg):
+            self._reply(code, json.dumps({"error": msg}))
+
+        def do_GET(self):
+            if self.path != "/status":
+                return self._error(404, "Unknown path: {}".format(self.path))
+            self._reply(200, json.dumps(index.stats()))
+
+        def do_POST(self):
+            if self.path != "/build":
+                return self._error(404, "Unknown path: {}".format(self.path))
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length).decode("utf-8"))
+                body, content_type = _serve_build(index, request, 
+                                                  output_dir)
+            except (ValueError, AttributeError, TypeError, KeyError) as err:
+                return self._error(400, "Invalid request: {}".format(err))
+            except (IOError, RuntimeError) as err:
+                return self._error(400, str(err))
+            self._reply(200, body, content_type)
+
+        def address_string(self):
+            # Unix socket clients have no address
+            if isinstance(self.client_address, tuple):
+                return str(self.client_address[0])
+            return "unix"
+
+        def log_message(self, fmt, *args):
+            if verbose:
+                BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    if isinstance(address, tuple):
+        return HTTPServer(address, Handler)
+
+    class UnixHTTPServer(socketserver.UnixStreamServer):
+        def server_bind(self):
+            socketserver.UnixStreamServer.server_bind(self)
+            self.server_name, self.server_port = "localhost", 0
+
+    if osp.exists(address):
+        os.unlink(address)
+
+    return UnixHTTPServer(address, Handler)
+
+
+def handle_serve_options(argv):
+    descr = """\
+    Run clark-biom as a long-running server that keeps the parsed abundance
+    tables in memory and builds tables for any subset of them on request.
+
+    Files are parsed the first time they are requested (or when the server
+    starts, see --manifest) and again only if their size or modification
+    time changes. Requests are made with a local HTTP JSON API:
+
+        POST /build   {"samples": [PATH or [PATH, SAMPLE-ID, GROUP], ...],
+                       "values": "count" | "pct" | "pct_all",
+                       "fmt": "hdf5" | "json" | "tsv",
+                       "output": PATH, "gzip": true | false}
+
+                      Writes the table to the output path (relative to
+                      --output-dir) and returns its path, shape and number
+                      of non-zero entries. Without an output path, JSON and
+                      TSV tables are returned in the response.
+
+        GET  /status  Returns the number of indexed samples, the number of
+                      files parsed and the number of requests for samples
+                      served from the index.
+
+    Usage example
+    -------------
+
+        $ clark-biom serve --socket /tmp/clark-biom.sock --manifest pool.tsv \\
+              --output-dir tables/
+        $ curl --unix-socket /tmp/clark-biom.sock localhost/build \\
+              -d '{"samples": ["S1.csv", "S2.csv"], "output": "proj.biom"}'
+
+
+    Program arguments
+    -----------------"""
+
+    parser = argparse.ArgumentParser(prog="clark-biom serve", 
+                        description=twdd(descr),
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', metavar="PATH",
+                        help="Listen on a Unix socket at this path instead "
+                             "of a TCP port.")
+    parser.add_argument('--host', default="127.0.0.1",
+                        help="Address to listen on. Default is 127.0.0.1 "
+                             "(local connections only).")
+    parser.add_argument('--port', type=int, default=8765,
+                        help="TCP port to listen on. Default is 8765.")
+    parser.add_argument('--manifest', metavar="MANIFEST-FILE",
+                        help="Parse the abundance tables listed in this "
+                             "manifest (see 'clark-biom -h') when the server "
+                             "starts.")
+    parser.add_argument('--output-dir', dest="output_dir", metavar="DIR",
+                        help="Directory that requested tables are written to; "
+                             "output paths outside of it are refused. Without "
+                             "it, tables can only be returned in responses.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Prints status messages and requests during "
+                             "program execution.")
+
+    args = parser.parse_args(argv)
+
+    if args.manifest and not osp.isfile(args.manifest):
+        parser.error("Manifest file not found: {}".format(args.manifest))
+    if args.output_dir:
+        if not osp.isdir(args.output_dir):
+            parser.error("Output directory not found: {}".format(
+                         args.output_dir))
+        args.output_dir = osp.realpath(args.output_dir)
+
+    return args
+
+
+def serve_main(argv):
+    args = handle_serve_options(argv)
+
+    index = SampleIndex()
+    if args.manifest:
+        try:
+            for entry in read_manifest(args.manifest):
+                index.get(entry.path)
+        except RuntimeError as re:
+            sys.exit(re)
+        if args.verbose:
+            print("Indexed {} samples from: {}".format(len(index), 
+                                                       args.manifest))
+
+    address = args.socket or (args.host, args.port)
+    server = make_server(index, address, args.verbose, args.output_dir)
+    # shut down cleanly (removing the socket) when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.verbose:
+        print("Listening on: {}".format(args.socket or 
+                                        "http://{}:{}".format(*address)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and osp.exists(args.socket):
+            os.unlink(args.socket)
 
 
 def main():
+    if sys.argv[1:2] == ["merge"]:
+        return merge_main(sys.argv[2:])
+    if sys.argv[1:2] == ["serve"]:
+        return serve_main(sys.argv[2:])
+
     args = handle_program_options()
 
     if args.fmt == 'hdf5' and not HAVE_H5PY:
@@ -320,34 +3201,232 @@ def main():
         Library 'h5py' not found, unable to write BIOM 2.x (HDF5) files.
         Defaulting to BIOM 1.0 (JSON)."""
         print(twdd(msg))
+        if args.direct_hdf5:
+            print("The --hdf5-* options have no effect on JSON tables.")
 
-    # load all abundance table files and parse them
-    sample_counts, taxa = process_samples(args.clark_abd_tbls, 
-                                          store_pct=args.store_pct)
+    parse_cache = None
+    if args.cache_dir:
+        try:
+            parse_cache = ParseCache(args.cache_dir, 
+                                     max_bytes=int(args.cache_size * 2**20))
+        except RuntimeError as re:
+            sys.exit(re)
+
+    stats = PipelineStats()
 
-    # create new BIOM table from sample counts and taxon ids
-    # add taxonomy strings to row (taxon) metadata
-    biomT = create_biom_table(sample_counts, taxa)
+    # input samples from the command line and/or manifest
+    entries = (sample_entry(fp) for fp in args.clark_abd_tbls)
+    if args.manifest:
+        entries = chain(entries, read_manifest(args.manifest))
+    if args.shard:
+        entries = shard_entries(entries, *args.shard)
+    groups = OrderedDict()
+    entries = record_groups(entries, groups)
 
-    out_fp = write_biom(biomT, args.output_fp, args.fmt, args.gzip)
+    # value columns to record, each written to its own table
+    kinds = args.values or (["pct"] if args.store_pct else ["count"])
+    table_fps = [args.output_fp] + [collapsed_fp(args.output_fp, kind)
+                                    for kind in kinds[1:]]
+
+    # load all abundance table files and parse them
+    tax_cache = TaxonomyCache()
+    lineages = LineageChecker() if args.lineage_report else None
+    if args.from_cohort or args.stream or len(kinds) > 1 or args.filter:
+        if args.from_cohort:
+            # the store provides the same interface as the streaming builder
+            try:
+                with stats.stage("load_cohort"):
+                    builders = [CohortStore.load(args.from_cohort)]
+                    groups = builders[0].groups
+            except (IOError, ValueError, RuntimeError) as err:
+                sys.exit("ERROR loading cohort {}: \n\t{}".format(
+                         args.from_cohort, err))
+            # the values can only be written as they were saved
+            stored = builders[0].kind
+            if (args.values or args.store_pct) and stored != kinds[0]:
+                if stored is None:
+                    sys.exit("ERROR: The cohort store {} does not record "
+                             "which values it holds, so --values and "
+                             "--store-pct cannot be used with it.".format(
+                             args.from_cohort))
+                sys.exit("ERROR: The cohort store {} holds '{}' values, not "
+                         "'{}'.".format(args.from_cohort, stored, kinds[0]))
+        else:
+            with stats.stage("process_samples") as rec:
+                samples = stream_samples(entries, 
+                                         jobs=args.jobs, tax_cache=tax_cache,
+                                         parse_cache=parse_cache,
+                                         columns=[value_kinds[kind] 
+                                                  for kind in kinds],
+                                         prefetch=args.prefetch)
+                if lineages is not None:
+                    samples = record_lineages(samples, lineages)
+                parsed = {}
+                samples = count_rows(samples, parsed)
+                if args.min_count is not None or args.top_n is not None:
+                    samples = filter_samples(samples, args.min_count, 
+                                             args.top_n)
+                try:
+                    builder = build_sparse_table(samples, dtype=[
+                                                 args.dtype or (np.int64 
+                                                 if kind == "count" else 
+                                                 np.float64) 
+                                                 for kind in kinds])
+                except RuntimeError as re:
+                    sys.exit(re)
+                if args.min_prevalence is not None:
+                    min_prevalence = args.min_prevalence
+                    if min_prevalence < 1:
+                        min_prevalence = np.ceil(min_prevalence * 
+                                                 builder.shape[1])
+                    builder.prune(min_prevalence)
+                rec["files"] = builder.shape[1]
+                rec["rows_parsed"] = parsed.get("rows", 0)
+                if args.filter:
+                    rec["rows_kept"] = builder.nnz
+            builders = builder.split()
+        biomTs = [None] * len(builders)
+        if args.fmt != "hdf5" or args.append_to:
+            with stats.stage("create_biom_table"):
+                biomTs = [builder.to_table(group_metadata(builder.sample_ids,
+                                                          groups))
+                          for builder in builders]
+    else:
+        with stats.stage("process_samples") as rec:
+            try:
+                sample_counts, taxa = process_samples(entries, 
+                                                      store_pct=args.store_pct,
+                                                      jobs=args.jobs,
+                                                      tax_cache=tax_cache,
+                                                      parse_cache=parse_cache,
+                                                      prefetch=args.prefetch,
+                                                      lineages=lineages)
+            except RuntimeError as re:
+                sys.exit(re)
+            rec["files"] = len(sample_counts)
+            rec["rows_parsed"] = sum(len(scounts) 
+                                     for scounts in sample_counts.values())
+
+        # create new BIOM table from sample counts and taxon ids
+        # add taxonomy strings to row (taxon) metadata
+        with stats.stage("create_biom_table"):
+            builders = [None]
+            biomTs = [create_biom_table(sample_counts, taxa, 
+                                        sparse=args.sparse,
+                                        sample_metadata=group_metadata(
+                                            sample_counts, groups),
+                                        dtype=args.dtype)]
+
+    if parse_cache is not None:
+        parse_cache.evict()
+
+    if lineages is not None:
+        try:
+            nconflicts = write_lineage_report(lineages, args.lineage_report)
+        except IOError as ioe:
+            sys.exit("ERROR writing lineage report: \n\t{}".format(ioe))
+        if nconflicts:
+            print("{} taxon IDs have inconsistent lineages across samples, "
+                  "see: {}".format(nconflicts, args.lineage_report))
+
+    if args.dump_cohort:
+        # only the first value column is saved
+        with stats.stage("dump_cohort"):
+            builder, biomT = builders[0], biomTs[0]
+            if biomT is None:
+                write_cohort_store(args.dump_cohort, 
+                                   sp.csc_matrix(builder.csc_arrays(), 
+                                              shape=builder.shape),
+                                   builder.taxa, builder.sample_ids, groups,
+                                   kinds[0])
+            else:
+                write_cohort_store(args.dump_cohort, biomT.matrix_data,
+                                   table_taxa(biomT), 
+                                   list(biomT.ids(axis="sample")), groups,
+                                   kinds[0])
+
+    if args.append_to:
+        try:
+            with stats.stage("append"):
+                biomTs[0] = join_tables([load_table(args.append_to), 
+                                         biomTs[0]])
+        except (IOError, RuntimeError, TypeError, ValueError) as err:
+            sys.exit("ERROR appending to {}: \n\t{}".format(args.append_to, err))
+
+    out_fps = []
+    with stats.stage("write_biom") as rec:
+        rec["bytes_written"] = 0
+        for table_fp, builder, biomT in zip(table_fps, builders, biomTs):
+            if biomT is None:
+                out_fp = write_hdf5_direct(builder, table_fp,
+                                           chunk_size=args.hdf5_chunk_size,
+                                           compression_level=
+                                               args.hdf5_compression_level,
+                                           sample_metadata=group_metadata(
+                                               builder.sample_ids, groups))
+                otu_ids = list(builder.taxa)
+                shape, nnz = builder.shape, builder.nnz
+            else:
+                out_fp = write_biom(biomT, table_fp, args.fmt, args.gzip,
+                                    compress_threads=args.compress_threads,
+                                    compress_level=args.compress_level)
+                otu_ids = list(biomT.ids(axis="observation"))
+                shape, nnz = biomT.shape, biomT.nnz
+            rec["bytes_written"] += osp.getsize(out_fp)
+            out_fps.append(out_fp)
+
+    if args.collapse_ranks:
+        with stats.stage("collapse_ranks") as rec:
+            rec["bytes_written"] = 0
+            for table_fp, builder, biomT in zip(table_fps, builders, biomTs):
+                if biomT is None:
+                    mtx, taxa = builder.to_csr(), builder.taxa
+                    sample_ids = builder.sample_ids
+                    sample_meta = group_metadata(sample_ids, groups)
+                else:
+                    mtx, taxa = biomT.matrix_data, table_taxa(biomT)
+                    sample_ids = list(biomT.ids(axis="sample"))
+                    sample_meta = biomT.metadata(axis="sample")
+                collapsed = collapse_ranks(mtx, taxa, sample_ids, 
+                                           args.collapse_ranks, sample_meta)
+                for rank, rank_table in collapsed.items():
+                    rank_fp = write_biom(rank_table, 
+                                         collapsed_fp(table_fp, rank),
+                                         args.fmt, args.gzip,
+                                         compress_threads=args.compress_threads,
+                                         compress_level=args.compress_level)
+                    rec["bytes_written"] += osp.getsize(rank_fp)
+                    if args.verbose:
+                        print("Table collapsed to rank '{}' ({} rows) written "
+                              "to: {}".format(rank, rank_table.shape[0], 
+                                              rank_fp))
 
     if args.otu_fp:
         try:
-            write_otu_file(list(taxa), args.otu_fp)
+            with stats.stage("write_otu_file") as rec:
+                write_otu_file(otu_ids, args.otu_fp)
+                rec["bytes_written"] = osp.getsize(args.otu_fp)
         except RuntimeError as re:
             msg = "ERROR creating OTU file: \n\t{}"
             sys.exit(msg.format(re))
 
+    if args.profile:
+        print(stats.summary())
+    if args.stats_json:
+        stats.to_json(args.stats_json)
+
     if args.verbose:
         print("".format(out_fp))
         table_str = """\
         BIOM-format table written to: {out_fp}
         Table contains {rows} rows (OTUs) and {cols} columns (Samples)
-        and is {density:.1%} dense.""".format(out_fp=out_fp, 
-                                              rows=biomT.shape[0], 
-                                              cols=biomT.shape[1],
-                                              density=biomT.get_table_density())
+        and is {density:.1%} dense.""".format(out_fp=", ".join(out_fps), 
+                                              rows=shape[0], 
+                                              cols=shape[1],
+                                              density=nnz / max(1, shape[0] * 
+                                                                  shape[1]))
         print(twdd(table_str))
+        print(tax_cache.stats())
 
 
 if __name__ == '__main__':
@@ -2,6 +2,7 @@
 # coding: utf-8
 from collections import OrderedDict
 import csv
+import gzip
 import importlib
 import io
 import os
@@ -59,6 +60,8 @@ class clark_biom_Test(unittest.TestCase):
         self.taxa.update(taxaB)
         self.sample_counts["A"] = countsA
         self.sample_counts["B"] = countsB
+        self.biomT_A = cb.create_biom_table(OrderedDict(A=countsA), taxaA)
+        self.biomT_B = cb.create_biom_table(OrderedDict(B=countsB), taxaB)
 
         # create the BIOM table from the sample counts and taxa
         self.biomT = cb.create_biom_table(self.sample_counts, self.taxa)
@@ -96,6 +99,111 @@ class clark_biom_Test(unittest.TestCase):
         self.assertTrue(all([self.biomT.get_value_by_ids(otu_id, "B") 
                              == countsB[otu_id] for otu_id in countsB]))
 
+    def test_sparse_matches_dense(self):
+        biomT_sparse = cb.create_biom_table(self.sample_counts, self.taxa,
+                                            sparse=True)
+
+        self.assertEqual(biomT_sparse, self.biomT)
+        self.assertEqual(biomT_sparse.nnz, 23)
+
+        # taxa missing from the mapping are left out either way
+        taxa = OrderedDict((taxid, self.taxa[taxid]) 
+                           for taxid in ("470", "732", "1382"))
+        dense = cb.create_biom_table(self.sample_counts, taxa)
+        self.assertEqual(cb.create_biom_table(self.sample_counts, taxa, 
+                                              sparse=True), dense)
+        self.assertEqual(dense.nnz, 4)
+
+    def test_float_values(self):
+        pctA, _ = cb.parse_clark_abundance_tbl(self.krepA, store_pct=True)
+        pct_counts = OrderedDict([("A", pctA)])
+        taxa = OrderedDict((taxid, self.taxa[taxid]) for taxid in pctA)
+
+        for sparse in (False, True):
+            biomT = cb.create_biom_table(pct_counts, taxa, sparse=sparse)
+            self.assertAlmostEqual(biomT.get_value_by_ids("470", "A"),
+                                   0.541033435)
+
+        mtx = cb.sparse_counts_matrix(pct_counts, taxa, dtype="float32")
+        self.assertEqual(mtx.dtype.name, "float32")
+
+    def test_cohort_query(self):
+        cohort = cb.Cohort.from_samples(self.sample_counts, self.taxa, 
+                                        {"A": "case", "B": "control"})
+        self.assertEqual(cohort.query().to_table(), self.biomT)
+        self.assertEqual(cohort.query(samples="A").to_table(), self.biomT_A)
+        self.assertEqual(cohort.query(group="control").sample_ids, ["B"])
+
+        sub = cohort.query(clade="p__Proteobacteria;c__Gammaproteobacteria")
+        self.assertEqual(sub.taxids, ["470", "714", "732", "739"])
+        self.assertEqual(sub.to_csr().toarray().tolist(),
+                         [[356, 200], [0, 212], [0, 2630], [0, 1]])
+
+        sub = cohort.query(samples=["A*"], clade="g__Aggregatibacter")
+        self.assertEqual(sub.shape, (0, 1))
+        sub = cohort.query(samples="A", clade="g__Aggregatibacter",
+                           drop_empty=False)
+        self.assertEqual(sub.shape, (3, 1))
+        self.assertEqual(sub.nnz, 0)
+
+    def test_join_tables(self):
+        joined = cb.join_tables([self.biomT_A, self.biomT_B])
+
+        self.assertEqual(joined, self.biomT)
+        self.assertRaises(RuntimeError, cb.join_tables, 
+                          [self.biomT_A, self.biomT_A])
+
+    def test_merge_main(self):
+        tmp_dir = tempfile.mkdtemp()
+        fps = [cb.write_biom(biomT, os.path.join(tmp_dir, name), fmt="json")
+               for biomT, name in [(self.biomT_A, "A.biom"), 
+                                   (self.biomT_B, "B.biom")]]
+        out_fp = os.path.join(tmp_dir, "merged.biom")
+        cb.merge_main(fps + ["-o", out_fp, "--fmt", "json"])
+
+        self.assertEqual(cb.load_table(out_fp), self.biomT)
+        for fp in fps + [out_fp]:
+            os.unlink(fp)
+        os.rmdir(tmp_dir)
+
+    def test_collapse_ranks(self):
+        collapsed = cb.collapse_ranks(self.biomT.matrix_data, self.taxa,
+                                      ["A", "B"], ["p", "g"])
+        phyla = collapsed["p"]
+
+        self.assertEqual(list(collapsed), ["p", "g"])
+        self.assertEqual(phyla.shape, (3, 2))
+        self.assertEqual(phyla.get_value_by_ids(
+                         "k__Bacteria;p__Proteobacteria", "A"), 438)
+        self.assertEqual(phyla.get_value_by_ids(
+                         "k__Bacteria;p__Proteobacteria", "B"), 3063)
+        self.assertEqual(phyla.get_value_by_ids(
+                         "k__Bacteria;p__Firmicutes", "A"), 0)
+        self.assertEqual(collapsed["g"].sum(), self.biomT.sum())
+
+    def test_parallel_gzip_writer(self):
+        out_fp = tempfile.NamedTemporaryFile(suffix=".gz", delete=False).name
+        text = self.biomT.to_tsv()
+        with cb.ParallelGzipWriter(out_fp, threads=3, level=1, 
+                                   block_size=64) as out_f:
+            out_f.writelines(text.splitlines(True))
+
+        with gzip.open(out_fp, "rt") as in_f:
+            self.assertEqual(in_f.read(), text)
+        os.unlink(out_fp)
+
+    def test_pipeline_stats(self):
+        stats = cb.PipelineStats()
+        with stats.stage("create_biom_table") as rec:
+            cb.create_biom_table(self.sample_counts, self.taxa)
+            rec["files"] = 2
+
+        record = stats.stages["create_biom_table"]
+        self.assertEqual(list(stats.stages), ["create_biom_table"])
+        self.assertEqual(record["files"], 2)
+        for key in ["wall_s", "cpu_s", "peak_rss_mb", "files_per_s"]:
+            self.assertIn(key, record)
+
 
 
     def tearDown(self):
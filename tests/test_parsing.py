@@ -8,6 +8,8 @@ import tempfile
 from textwrap import dedent as twdd
 import unittest
 
+import numpy as np
+
 import clark_biom as cb
 
 
@@ -32,6 +34,13 @@ class clark_biom_Test(unittest.TestCase):
             Actinomyces meyeri,52773,Bacteria;Actinobacteria;Actinobacteria;Actinomycetales;Actinomycetaceae;Actinomyces,81,0.00140581,0.123100304
             UNKNOWN,UNKNOWN,UNKNOWN,658,92.0161,-
             """)))
+        self.sample_clark_cols = cb.read_clark_columns(
+                io.StringIO(twdd(u"""\
+            Name,TaxID,Lineage,Count,Proportion_All(%),Proportion_Classified(%)
+            Achromobacter xylosoxidans,85698,Bacteria;Proteobacteria;Betaproteobacteria;Burkholderiales;Alcaligenaceae;Achromobacter,82,0.00142317,0.124620061
+            Acinetobacter baumannii,470,Bacteria;Proteobacteria;Gammaproteobacteria;Pseudomonadales;Moraxellaceae;Acinetobacter,356,0.00617862,0.541033435
+            UNKNOWN,UNKNOWN,UNKNOWN,658,92.0161,-
+            """)), columns=("Count", "Proportion_Classified(%)"))
 
     def run_parse_clark_report(self, manual):
         counts, _ = cb.parse_clark_abundance_tbl(self.sample_clark_rep)
@@ -90,6 +99,54 @@ class clark_biom_Test(unittest.TestCase):
         self.assertTrue(all([manual[tax_id] == taxa[tax_id] for tax_id in manual]))
 
 
+    def test_read_clark_columns(self):
+        cols = self.sample_clark_cols
+
+        self.assertEqual(cols.taxids.dtype, np.int64)
+        self.assertEqual(cols.taxids.tolist(), [85698, 470])
+        self.assertEqual(cols.names, ["Achromobacter xylosoxidans",
+                                      "Acinetobacter baumannii"])
+        self.assertEqual(cols.values["Count"].dtype, np.int64)
+        self.assertEqual(cols.values["Count"].tolist(), [82, 356])
+        self.assertTrue(np.allclose(cols.values["Proportion_Classified(%)"],
+                                    [0.124620061, 0.541033435]))
+
+
+    def test_taxonomy_cache(self):
+        tax_cache = cb.TaxonomyCache(maxsize=2)
+        lineage = "Bacteria;Firmicutes;Bacilli;Bacillales;Bacillaceae;Bacillus"
+        tax = tax_cache.get("1423", lineage, "Bacillus subtilis")
+
+        self.assertEqual(tax, cb.tax_fmt(lineage, "Bacillus subtilis"))
+        # known taxon ID and interned lineage return the same object
+        self.assertIs(tax_cache.get("1423", lineage, "Bacillus subtilis"), tax)
+        self.assertIs(tax_cache.get("9999", lineage, "Bacillus subtilis"), tax)
+        self.assertEqual((tax_cache.hits, tax_cache.misses), (2, 1))
+
+        tax_cache.get("1", "Bacteria", "Bacteria")
+        tax_cache.get("2", "Archaea", "Archaea")
+        self.assertEqual(len(tax_cache), 2)
+
+        # a known taxon ID given another lineage is not masked
+        tax = tax_cache.get("1423", "Bacteria;Firmicutes", "Firmicutes")
+        self.assertEqual(tax, ["k__Bacteria", "p__Firmicutes"])
+
+    def test_batch_taxonomy(self):
+        lineages = ["Bacteria;Firmicutes;Bacilli;Bacillales;Bacillaceae;Bacillus",
+                    "Bacteria;Firmicutes",
+                    "Bacteria;Firmicutes;Bacilli;Bacillales;Bacillaceae;Bacillus"]
+        names = ["Bacillus subtilis", "Firmicutes", "Bacillus subtilis"]
+        batch = cb.batch_taxonomy(lineages, names)
+
+        self.assertEqual(len(batch.taxonomies), 2)
+        self.assertEqual([batch.taxonomies[i] for i in batch.inverse],
+                         [cb.tax_fmt(l, n) for l, n in zip(lineages, names)])
+        codes = batch.codes[batch.inverse]
+        self.assertEqual(codes[0].tolist()[:2], codes[1].tolist()[:2])
+        self.assertEqual(codes[1].tolist()[2:], [-1] * 5)
+        self.assertEqual(batch.rank_names[-1][codes[0, -1]], "s__subtilis")
+
+
     def tearDown(self):
         pass
 
@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 # coding: utf-8
+import bz2
+from collections import OrderedDict
+import gzip
 import os, os.path as osp
+import shutil
 import tempfile
 from textwrap import dedent as twdd
 import unittest
 
+import numpy as np
 import clark_biom as cb
 from tests.test_parsing import prep_clark_input
 
@@ -121,6 +126,282 @@ class clark_biom_Test(unittest.TestCase):
                                for tax_id in manual]))
 
 
+    def test_parallel_matches_serial(self):
+        sample_counts, taxa = cb.process_samples(self.fps, store_pct=False,
+                                                 jobs=2)
+
+        self.assertEqual(list(sample_counts), list(self.sample_counts))
+        self.assertEqual(sample_counts, self.sample_counts)
+        self.assertEqual(list(taxa), list(self.taxa))
+        self.assertEqual(taxa, self.taxa)
+
+
+    def test_build_sparse_table(self):
+        samples = cb.stream_samples(self.fps, store_pct=False)
+        builder = cb.build_sparse_table(samples)
+        biomT = cb.create_biom_table(self.sample_counts, self.taxa)
+
+        self.assertEqual(builder.sample_ids, self.fnames)
+        self.assertEqual(list(builder.taxa), list(self.taxa))
+        self.assertEqual(builder.nnz, 23)
+        self.assertEqual(builder.to_table(), biomT)
+
+    def test_non_integer_taxon_id(self):
+        # only the renamed taxon loses its counts
+        taxa = OrderedDict(("renamed" if taxid == "470" else taxid, tax)
+                           for taxid, tax in self.taxa.items())
+        for sparse in (False, True):
+            biomT = cb.create_biom_table(self.sample_counts, taxa, 
+                                         sparse=sparse)
+            self.assertEqual(biomT.nnz, 21)
+            self.assertEqual(biomT.data("renamed", axis="observation").sum(),
+                             0)
+            self.assertEqual(biomT.get_value_by_ids("85698", self.fnames[0]
+                                                    .split(".")[0]), 82)
+
+    def test_taxon_index(self):
+        index = cb.TaxonIndex()
+        rows = index.intern(np.array([30, 10, 30, 20]))
+        self.assertEqual(rows.tolist(), [0, 1, 0, 2])
+        self.assertEqual(index.intern([20, 40, 10]).tolist(), [2, 3, 1])
+        self.assertEqual(index.ids(), ["30", "10", "20", "40"])
+
+        counts = cb.SampleCounts(index, rows[1:], np.array([5, 1, 2]))
+        self.assertEqual(dict(counts), {"10": 5, "30": 1, "20": 2})
+        self.assertEqual(counts["20"], 2)
+        self.assertNotIn("40", counts)
+
+    def test_cohort_store(self):
+        builder = cb.build_sparse_table(cb.stream_samples(self.fps))
+        store_dir = cb.write_cohort_store(tempfile.mkdtemp(), builder.to_csr(),
+                                          builder.taxa, builder.sample_ids,
+                                          {self.fnames[0]: "g1"}, "count")
+        store = cb.CohortStore.load(store_dir)
+
+        self.assertEqual(store.shape, builder.shape)
+        self.assertEqual(store.taxa, builder.taxa)
+        self.assertEqual(store.groups, {self.fnames[0]: "g1"})
+        self.assertEqual(store.kind, "count")
+        self.assertEqual(store.to_table(), builder.to_table())
+
+        subset = store.select(self.fnames[1:])
+        self.assertEqual(subset.sample_ids, self.fnames[1:])
+        self.assertEqual(subset.to_csr().toarray().tolist(),
+                         builder.to_csr()[:, 1:].toarray().tolist())
+        self.assertRaises(RuntimeError, store.select, ["missing"])
+        del store, subset
+        shutil.rmtree(store_dir)
+
+    def test_multiple_value_columns(self):
+        columns = ["Count", "Proportion_Classified(%)"]
+        samples = cb.stream_samples(self.fps, columns=columns)
+        builder = cb.build_sparse_table(samples, dtype=[np.int64, float])
+        counts, pcts = builder.split()
+
+        for store_pct, split_builder in [(False, counts), (True, pcts)]:
+            single = cb.build_sparse_table(cb.stream_samples(self.fps, 
+                                                             store_pct),
+                                           dtype=float)
+            self.assertEqual(split_builder.taxa, single.taxa)
+            self.assertEqual(split_builder.to_table(), single.to_table())
+
+    def test_filter_samples(self):
+        samples = cb.filter_samples(cb.stream_samples(self.fps), min_count=10)
+        builder = cb.build_sparse_table(samples)
+        self.assertEqual(builder.nnz, 11)
+        self.assertEqual(builder.prevalence.tolist()[:2], [2, 2])
+
+        builder.prune(2)
+        self.assertEqual(list(builder.taxa), ["85698", "470"])
+        self.assertEqual(builder.to_csr().toarray().tolist(), 
+                         [[82, 10], [356, 200]])
+
+        samples = cb.filter_samples(cb.stream_samples(self.fps), top_n=2)
+        builder = cb.build_sparse_table(samples)
+        self.assertEqual(list(builder.taxa), ["470", "1659", "714", "732"])
+
+    def test_sample_index(self):
+        index = cb.SampleIndex()
+        builder, groups = index.build([self.fps[0], (self.fps[1], "B", "g")])
+        self.assertEqual(builder.sample_ids, [self.fnames[0], "B"])
+        self.assertEqual(groups, {"B": "g"})
+        self.assertEqual(builder.to_table().ids(axis="observation").tolist(), 
+                         list(self.taxa))
+        self.assertEqual((index.parsed, index.hits), (2, 0))
+
+        # served from the index until the file changes
+        pct_builder, _ = index.build(self.fps[:1], "pct")
+        self.assertAlmostEqual(pct_builder.to_csr()[1, 0], 0.541033435)
+        st = os.stat(self.fps[0])
+        os.utime(self.fps[0], (st.st_atime, st.st_mtime + 10))
+        index.build(self.fps)
+        self.assertEqual((index.parsed, index.hits), (3, 2))
+
+        body, content_type = cb._serve_build(index, {"samples": self.fps,
+                                                     "fmt": "tsv"})
+        self.assertEqual(content_type, "text/tab-separated-values")
+        self.assertEqual(len(body.splitlines()), 2 + len(self.taxa))
+        self.assertRaises(RuntimeError, cb._serve_build, index, 
+                          {"samples": self.fps})
+        for samples in (5, [{"a": 1}], [[self.fps[0], 1]]):
+            self.assertRaises(RuntimeError, cb._serve_build, index, 
+                              {"samples": samples, "fmt": "tsv"})
+
+        # tables are only written within the output directory
+        out_dir = osp.realpath(tempfile.mkdtemp())
+        request = {"samples": self.fps, "fmt": "tsv", "output": "t.tsv"}
+        self.assertRaises(RuntimeError, cb._serve_build, index, request)
+        cb._serve_build(index, request, out_dir)
+        self.assertTrue(osp.isfile(osp.join(out_dir, "t.tsv")))
+        request["output"] = "../t.tsv"
+        self.assertRaises(RuntimeError, cb._serve_build, index, request, 
+                          out_dir)
+        shutil.rmtree(out_dir)
+
+    def test_duplicate_sample_id(self):
+        samples = cb.stream_samples(self.fps + self.fps[:1])
+
+        self.assertRaises(RuntimeError, cb.build_sparse_table, samples)
+        self.assertRaises(RuntimeError, cb.process_samples, 
+                          self.fps + self.fps[:1])
+
+
+    def test_parse_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        parse_cache = cb.ParseCache(cache_dir)
+        sample_counts, taxa = cb.process_samples(self.fps, 
+                                                 parse_cache=parse_cache)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+        cached_counts, cached_taxa = cb.process_samples(self.fps, 
+                                                        parse_cache=parse_cache)
+        self.assertEqual(cached_counts, self.sample_counts)
+        self.assertEqual(cached_taxa, self.taxa)
+
+        # values for other columns are served from the same cache entries
+        pct_counts, _ = cb.process_samples(self.fps, store_pct=True,
+                                           parse_cache=parse_cache)
+        self.assertAlmostEqual(pct_counts[self.fnames[0]]['470'], 0.541033435)
+
+        # cached files are not read ahead
+        self.assertTrue(parse_cache.contains(self.fps[0]))
+        prefetched = cb.prefetch_files(self.fps, skip=parse_cache.contains)
+        self.assertEqual([data for _, data in prefetched], [None, None])
+        prefetch_counts, _ = cb.process_samples(self.fps, prefetch=2,
+                                                parse_cache=parse_cache)
+        self.assertEqual(prefetch_counts, self.sample_counts)
+
+        # a damaged entry is a cache miss
+        cache_fp = parse_cache._path(self.fps[0])
+        with open(cache_fp, "r+b") as cache_f:
+            cache_f.truncate(os.path.getsize(cache_fp) // 2)
+        self.assertIsNone(parse_cache.load(self.fps[0]))
+        damaged_counts, _ = cb.process_samples(self.fps, 
+                                               parse_cache=parse_cache)
+        self.assertEqual(damaged_counts, self.sample_counts)
+
+        cb.ParseCache(cache_dir, max_bytes=0).evict()
+        self.assertEqual(os.listdir(cache_dir), [])
+        os.rmdir(cache_dir)
+
+
+    @unittest.skipUnless(cb.HAVE_H5PY, "requires h5py")
+    def test_write_hdf5_direct(self):
+        builder = cb.build_sparse_table(cb.stream_samples(self.fps))
+        out_fp = tempfile.NamedTemporaryFile(suffix=".biom", delete=False).name
+        cb.write_hdf5_direct(builder, out_fp, chunk_size=4)
+
+        biomT = cb.load_table(out_fp)
+        os.unlink(out_fp)
+        self.assertEqual(biomT, builder.to_table())
+
+
+    def test_compressed_input(self):
+        comp_fps = []
+        for fp, ext, opener in zip(self.fps, [".csv.gz", ".csv.bz2"],
+                                   [gzip.open, bz2.BZ2File]):
+            comp_fp = fp + ext
+            with open(fp, "rb") as in_f, opener(comp_fp, "wb") as out_f:
+                out_f.write(in_f.read())
+            comp_fps.append(comp_fp)
+
+        sample_counts, taxa = cb.process_samples(comp_fps)
+        prefetched_counts, _ = cb.process_samples(comp_fps, prefetch=1)
+        for comp_fp in comp_fps:
+            os.unlink(comp_fp)
+
+        self.assertEqual(list(sample_counts), self.fnames)
+        self.assertEqual(list(sample_counts.values()), 
+                         list(self.sample_counts.values()))
+        self.assertEqual(taxa, self.taxa)
+        self.assertEqual(prefetched_counts, sample_counts)
+
+    @unittest.skipUnless(cb.HAVE_LZMA, "requires lzma")
+    def test_corrupt_input(self):
+        with open(self.fps[0], "rb") as in_f:
+            data = cb.lzma.compress(in_f.read())
+        corrupt_fp = self.fps[0] + ".csv.xz"
+        with open(corrupt_fp, "wb") as out_f:
+            out_f.write(data[:20] + b"\0" * 10 + data[30:])
+
+        for prefetch in (0, 1):
+            self.assertRaises(RuntimeError, cb.process_samples, [corrupt_fp],
+                              prefetch=prefetch)
+        os.unlink(corrupt_fp)
+
+    def test_prefetch(self):
+        sample_counts, taxa = cb.process_samples(self.fps, prefetch=2)
+
+        self.assertEqual(sample_counts, self.sample_counts)
+        self.assertEqual(taxa, self.taxa)
+        self.assertRaises(RuntimeError, cb.process_samples, 
+                          self.fps + ["missing.csv"], prefetch=2)
+
+    def test_lineage_conflicts(self):
+        # the same taxon ID with another genus in a third sample
+        crepC = self.crepB.replace(b"Pseudomonadales;Moraxellaceae;"
+                                   b"Acinetobacter", b"Pseudomonadales;"
+                                   b"Moraxellaceae;Psychrobacter")
+        tempf_crepC = tempfile.NamedTemporaryFile(delete=False)
+        tempf_crepC.write(crepC)
+        tempf_crepC.close()
+        self.fps.append(tempf_crepC.name)
+        sample_ids = [osp.splitext(fname)[0] for fname in self.fnames]
+        sample_ids.append(osp.splitext(osp.split(tempf_crepC.name)[1])[0])
+
+        lineages = cb.LineageChecker()
+        _, taxa = cb.process_samples(self.fps, lineages=lineages)
+        self.assertEqual(taxa["470"][-1], "g__Psychrobacter")
+
+        # only the first sample is recorded for the lineage seen before
+        conflicts = lineages.conflicts
+        self.assertEqual(list(conflicts), [470])
+        self.assertEqual(list(conflicts[470].values()), 
+                         [sample_ids[:1], sample_ids[2:]])
+
+
+    def test_manifest(self):
+        manifest = tempfile.NamedTemporaryFile(mode="w", suffix=".tsv", 
+                                               delete=False)
+        manifest.write("# cohort samples\n\n")
+        manifest.write("path\tsample_id\tgroup\n")
+        manifest.write("{}\tA\tcase\n".format(self.fps[0]))
+        manifest.write("\n{}\n".format(self.fps[1]))
+        manifest.close()
+
+        entries = list(cb.read_manifest(manifest.name))
+        os.unlink(manifest.name)
+        self.assertEqual(entries, 
+                         [cb.SampleEntry(self.fps[0], "A", "case"),
+                          cb.SampleEntry(self.fps[1], self.fnames[1], None)])
+        self.assertEqual(list(cb.shard_entries(entries, 2, 2)), entries[1:])
+
+        sample_counts, _ = cb.process_samples(entries)
+        self.assertEqual(list(sample_counts), ["A", self.fnames[1]])
+        self.assertEqual(sample_counts["A"], 
+                         self.sample_counts[self.fnames[0]])
+
+
 
     def tearDown(self):
         for fp in self.fps: